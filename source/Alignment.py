@@ -4,6 +4,11 @@ A wrapper class to accomodate different genome sequence aligners.
 Aligners currently supported (config file aligner name):
     --Bowtie (bowtie)
     --BWA-MEM (bwamem)
+
+Each aligner is a backend class that knows its command lines, index files
+and multi-mapping and thread settings.  The artificial reads of homolog
+discovery (--tile_aligner) and the sample reads of the pileup stage
+(--read_aligner) can use different backends
 """
 
 #Global
@@ -15,24 +20,162 @@ import sys
 from tools.io.Log import Log
 
 #Local
+from Metrics import Stage
+
+BOWTIE2_OPTIONS = "-k 10"  #report up to 10 alignments per read
+BWA_MEM_OPTIONS = "-a"  #report all alignments of each read as secondary alignments
+MAX_ALIGNMENTS = 10  #alignments kept per read from BWA-MEM, as Bowtie 2's -k 10
+COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+
+class Bowtie2:
+    """Bowtie 2 backend (aligner name bowtie)"""
+    name = "Bowtie 2"
+    stage = "bowtie2"  #Metrics stage names
+    build_stage = "bowtie2-build"
+    options = BOWTIE2_OPTIONS
+    rewrites_output = False  #the aligner's SAM output is used as written
+
+    def __init__(self, args):
+        """Takes the argparse object from hpileup for the tool location and
+        default index (--bowtie2_loc and --bowtie2_ref)"""
+        self.args = args
+        self.tool = args.bowtie2_loc
+        self.build_tool = args.bowtie2_loc+"-build"
+        self.default_index = args.bowtie2_ref
+
+    def description(self):
+        """Returns the aligner and options that determine its alignments"""
+        return "bowtie2 "+self.options
+
+    def index_file(self, index):
+        """Returns the file that exists once the index prefix index is built"""
+        return index+".1.bt2"
+
+    def cmd(self, index, fastq_path, out_sam_path, threads):
+        """Returns the alignment command line.  Bowtie 2 reads stdin when the
+        fastq path is '-' and writes stdout when no -S path is given"""
+        cmd = self.tool+" -x "+index
+        cmd += " -p "+str(threads)+" "+self.options+" -U "
+        cmd += fastq_path
+        if out_sam_path != "-":
+            cmd += " -S "+out_sam_path
+        return cmd
+
+    def build_cmd(self, fasta_path, index, threads):
+        """Returns the command line that indexes fasta_path at the prefix index"""
+        return self.build_tool+" --threads "+str(threads)+" "+fasta_path+" "+index
+
+    def sam_lines(self, lines):
+        """Returns the SAM lines written by the aligner, which need no changes"""
+        return lines
+
+class BwaMem:
+    """BWA-MEM backend (aligner name bwamem).  BWA-MEM has no limit on the
+    number of reported alignments like Bowtie 2's -k; with -a every
+    alignment above its score threshold is written as a secondary one,
+    without SEQ/QUAL.  Its output is passed through sam_lines, which
+    restores those from the primary alignment, keeps at most
+    MAX_ALIGNMENTS alignments per read and drops supplementary ones, so it
+    can be used like Bowtie 2 -k 10 output"""
+    name = "BWA-MEM"
+    stage = "bwa-mem"
+    build_stage = "bwa-index"
+    options = BWA_MEM_OPTIONS
+    rewrites_output = True
+
+    def __init__(self, args):
+        """Takes the argparse object from hpileup for the tool location and
+        default index (--bwa_loc and --bwa_ref)"""
+        self.args = args
+        self.tool = args.bwa_loc
+        self.build_tool = args.bwa_loc
+        self.default_index = args.bwa_ref
+
+    def description(self):
+        """Returns the aligner and options that determine its alignments"""
+        return "bwa mem "+self.options+" max "+str(MAX_ALIGNMENTS)
+
+    def index_file(self, index):
+        """Returns the file that exists once the index prefix index is built"""
+        return index+".bwt"
+
+    def cmd(self, index, fastq_path, out_sam_path, threads):
+        """Returns the alignment command line.  BWA reads stdin when the fastq
+        path is '-' and always writes to stdout; its output must go through
+        sam_lines (Alignment.call_aligner writes out_sam_path that way)"""
+        return self.tool+" mem -t "+str(threads)+" "+self.options+" "+index+" "+fastq_path
+
+    def build_cmd(self, fasta_path, index, threads):
+        """Returns the command line that indexes fasta_path at the prefix index
+        (bwa index is single-threaded)"""
+        return self.build_tool+" index -p "+index+" "+fasta_path
+
+    def sam_lines(self, lines):
+        """Generator over the SAM lines written by BWA-MEM with the SEQ and
+        QUAL of secondary alignments copied from the read's primary
+        alignment (reverse complemented if they are on opposite strands),
+        at most MAX_ALIGNMENTS alignments per read and no supplementary
+        alignments (flag 2048), which hold only a hard clipped part of a
+        read whose primary alignment is already kept.  BWA writes every
+        read's primary alignment before its secondary ones"""
+        primary = None  #(qname, reverse, seq, qual) of the last primary alignment
+        kept = 0  #alignments kept for the read of primary
+        for line in lines:
+            if line[0] == "@":
+                yield line
+                continue
+            linevals = line.rstrip('\n').split('\t', 11)
+            flag = int(linevals[1])
+            if flag & 2048:
+                continue
+            if not flag & 256:
+                primary = (linevals[0], bool(flag & 16), linevals[9], linevals[10])
+                kept = 1
+                yield line
+                continue
+            if primary == None or primary[0] != linevals[0] or kept >= MAX_ALIGNMENTS:
+                continue  #beyond the cap, or no primary alignment to take the bases from
+            qname, reverse, seq, qual = primary
+            if bool(flag & 16) != reverse:
+                seq = seq.translate(COMPLEMENT)[::-1]
+                qual = qual[::-1]
+            linevals[9] = seq
+            linevals[10] = qual
+            kept += 1
+            yield '\t'.join(linevals)+'\n'
+
+ALIGNERS = {"bowtie": Bowtie2, "bwamem": BwaMem}  #{config file aligner name: backend class}
+
+def backend(args, name):
+    """Returns the backend of the aligner called name (see ALIGNERS)"""
+    return ALIGNERS[name](args)
 
 class Alignment:
     """Wrapper class for calling different aligners in the
     pipeline"""
-    def __init__(self, args, fastq_path, out_sam_path):
-        """Takes the argparse object from Hpileup (for bowtie2 configs, and an
-        input fastq path and output sam path, and performs bowtie2 alignment.
-        Hardcoded to use the -k 10 alignment option"""
+    def __init__(self, args, fastq_path, out_sam_path, run=True, ref=None, aligner=None, threads=None):
+        """Takes the argparse object from Hpileup (for aligner configs), an
+        input fastq path and output sam path, and performs the alignment with
+        the aligner backend (Bowtie 2 by default), reporting multiple
+        alignments per read.  If run is False the aligner is not called and
+        cmd() can be used inside a pipeline, where fastq_path and
+        out_sam_path may be '-' for stdin and stdout.  ref is an alternative
+        index prefix to the backend's default index and threads the number
+        of aligner threads (args.threads by default)"""
         self.args = args
         self.fastq_path = fastq_path
         self.out_sam_path = out_sam_path
+        self.aligner = aligner if aligner != None else Bowtie2(args)
+        self.ref = ref if ref != None else self.aligner.default_index
+        self.threads = threads if threads != None else args.threads
         self.l = Log()
         
-        self.l.log("Alignment: Preparing to align "+self.fastq_path+" to "+args.bowtie2_ref)
+        self.l.log("Alignment: Preparing to align "+self.fastq_path+" to "+self.ref+" with "+self.aligner.name)
         self.l.log("Alignment: Checking file locations...")
         self.check_files()
-        self.l.log("Alignment: Reference files ready, preparing to call Bowtie...")
-        self.call_aligner()
+        if run:
+            self.l.log("Alignment: Reference files ready, preparing to call "+self.aligner.name+"...")
+            self.call_aligner()
 
     """
     Pre-processing
@@ -41,22 +184,39 @@ class Alignment:
     def check_files(self):
         """Checks if all the files specified for alignment are correct
         and in the right place"""
-        if not os.path.isfile(self.args.bowtie2_ref+".1.bt2"):  #check if user has generated bowtie ref files
-            self.l.error("Alignment: Valid bowtie reference files not found at "+self.args.bowtie2_ref,
+        if not os.path.isfile(self.aligner.index_file(self.ref)):  #check if user has generated the index files
+            self.l.error("Alignment: Valid "+self.aligner.name+" reference files not found at "+self.ref,
                             die=True, code=1)
 
     """
     Alignment Wrapping
     """
 
+    def cmd(self):
+        """Returns the aligner command line.  If the backend rewrites its
+        output (BWA-MEM), lines read from the command's stdout must be
+        passed through self.aligner.sam_lines"""
+        return self.aligner.cmd(self.ref, self.fastq_path, self.out_sam_path, self.threads)
+
     def call_aligner(self):
-        """Uses subprocess to make calls to the aligner based on specified aligner name"""
-        cmd = self.args.bowtie2_loc+" -x "+self.args.bowtie2_ref
-        cmd += " -p "+str(self.args.threads)+" -k 10 -U "
-        cmd += self.fastq_path+" -S "+self.out_sam_path
-        self.l.log("Calling Bowtie 2 with the following command...\n\t"+cmd)
-        subprocess.call(cmd, shell=True)
-        self.l.log("Bowtie 2 finished")
+        """Uses subprocess to make calls to the aligner based on specified
+        aligner name.  Output that the backend rewrites is read from the
+        aligner's stdout and written to out_sam_path through its sam_lines"""
+        cmd = self.cmd()
+        self.l.log("Calling "+self.aligner.name+" with the following command...\n\t"+cmd)
+        with Stage(self.args, self.aligner.stage, sample=self.fastq_path) as stage:
+            if self.aligner.rewrites_output and self.out_sam_path != "-":
+                proc = stage.popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+                out = open(self.out_sam_path, 'w')
+                out.writelines(self.aligner.sam_lines(proc.stdout))
+                out.close()
+                proc.stdout.close()
+                code = stage.wait(proc)
+            else:
+                code = stage.call(cmd)
+        if code != 0:
+            self.l.error("Alignment: "+self.aligner.name+" failed on "+self.fastq_path, die=True, code=1)
+        self.l.log(self.aligner.name+" finished")
 
 if __name__ == "__main__":
     print("Alignment.py")
@@ -0,0 +1,127 @@
+"""
+This script defines stage checkpoints for the pipeline.  Before a stage
+runs, a digest of its input files, parameters and tool versions is
+compared with the manifest written the last time it finished; if they
+match and its outputs are unchanged since then, the stage is skipped.
+Manifests are kept in args.outdir/checkpoints/ and --force ignores them
+"""
+
+#Global
+import hashlib
+import json
+import os
+import subprocess
+
+#Repos
+from tools.io.Log import Log
+
+#Local
+
+CONTENT_HASH_LIMIT = 64*1024*1024  #files up to this size (bytes) are hashed by content
+TOOL_VERSIONS = {}  #{tool command: version string}, filled once per process
+FILE_DIGESTS = {}  #{(path, size, modification time, inode): digest}, filled as files are hashed
+
+def file_digest(path):
+    """Returns a digest of the file at path: a hash of its content for files
+    up to CONTENT_HASH_LIMIT bytes, otherwise of its size and modification
+    time, so large BAMs and indexes are not read on every run.  Content
+    hashes are kept for the rest of the process and reused while the
+    file's size, modification time and inode are unchanged, so inputs
+    shared by many checkpoints (the GATK jar, the reference) are read once.
+    Missing files digest to None"""
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    if stat.st_size > CONTENT_HASH_LIMIT:
+        return "stat:"+str(stat.st_size)+":"+str(stat.st_mtime_ns)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    if key not in FILE_DIGESTS:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(1024*1024), b""):
+                sha.update(block)
+        FILE_DIGESTS[key] = "sha1:"+sha.hexdigest()
+    return FILE_DIGESTS[key]
+
+def tool_version(tool):
+    """Returns the first line printed by 'tool --version', or 'unknown'"""
+    if tool not in TOOL_VERSIONS:
+        try:
+            out = subprocess.check_output(tool+" --version", shell=True, stderr=subprocess.STDOUT,
+                                            universal_newlines=True)
+            TOOL_VERSIONS[tool] = out.strip().split('\n')[0]
+        except (subprocess.CalledProcessError, OSError):
+            TOOL_VERSIONS[tool] = "unknown"
+    return TOOL_VERSIONS[tool]
+
+class Checkpoint:
+    """Manifest of one run of a stage: the digest of what it was run on and
+    the size and modification time of the outputs it wrote"""
+    def __init__(self, args, name, inputs, outputs, params=None, tools=None):
+        """name identifies the stage (e.g. 'pileup:<sample>'), inputs and
+        outputs are file paths, params a JSON-serializable dict of settings
+        and tools a list of command-line tools whose versions are recorded"""
+        self.args = args
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params if params != None else {}
+        self.tools = tools if tools != None else []
+        self.path = self.args.outdir+"checkpoints/"+hashlib.sha1(name.encode()).hexdigest()[:16]+".json"
+        self.l = Log()
+
+    """
+    Digests
+    """
+
+    def digest(self):
+        """Returns the hash of the inputs, parameters and tool versions"""
+        state = {"inputs": dict([(path, file_digest(path)) for path in self.inputs]),
+                    "params": self.params,
+                    "tools": dict([(tool, tool_version(tool)) for tool in self.tools])}
+        return hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+    def output_stats(self):
+        """Returns {output path: [size, modification time]} of the outputs"""
+        stats = {}
+        for path in self.outputs:
+            stat = os.stat(path)
+            stats[path] = [stat.st_size, stat.st_mtime_ns]
+        return stats
+
+    """
+    Checking and recording
+    """
+
+    def valid(self):
+        """Returns True if the stage finished before with the same digest and
+        its outputs have not changed since.  Otherwise the old manifest is
+        removed, so a stage that fails now is redone on the next run"""
+        if not self.args.force and os.path.isfile(self.path):
+            try:
+                manifest = json.load(open(self.path))
+                if (manifest["digest"] == self.digest() and
+                        all([os.path.isfile(path) for path in self.outputs]) and
+                        manifest["outputs"] == self.output_stats()):
+                    self.l.log("Checkpoint: Skipping "+self.name+", outputs are up to date")
+                    return True
+            except (ValueError, KeyError):
+                pass
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        return False
+
+    def done(self):
+        """Records the manifest after the stage has written its outputs.
+        Nothing is recorded if an output is missing"""
+        missing = [path for path in self.outputs if not os.path.isfile(path)]
+        if len(missing) > 0:
+            self.l.log("Checkpoint: Not recording "+self.name+", missing outputs: "+', '.join(missing))
+            return
+        os.makedirs(self.args.outdir+"checkpoints/", exist_ok=True)
+        manifest = {"name": self.name, "digest": self.digest(), "outputs": self.output_stats()}
+        json.dump(manifest, open(self.path+".tmp", 'w'), indent=1, sort_keys=True)
+        os.replace(self.path+".tmp", self.path)
+
+if __name__ == "__main__":
+    print("Checkpoint.py")
@@ -5,7 +5,8 @@ a fraction overlap of their basepairs with the previous and next reads.
 """
 
 #Global
-from Bio import SeqIO
+import gzip
+import io
 import sys
 
 #Repos
@@ -13,98 +14,105 @@ import tools.formats.Bed as Bed
 from tools.io.Log import Log
 
 #Local
+from Reference import Reference
+
+WRITE_BUFFER = 1024*1024  #write buffer size (bytes) for uncompressed output
+GZIP_LEVEL = 1  #gzip level for .gz output; the file is only read once by the aligner
 
 class FakeFastq:
     """Implements simulations of a fastq file with reads based on
-    input regions with configurable length and overlap wtih each other"""
+    input regions with configurable length and overlap wtih each other.
+    Reads are generated lazily and written straight to the output file"""
     def __init__(self, bedfile, refpath, readlen=1000, overlap=0.75):
-        """Using the regions in bedfile, creates a fastq file with 'reads' generated
+        """Using the regions in bedfile, prepares to generate 'reads'
         from refpath of length readlen and overlap fraction overlap"""
         self.l = Log()
         self.l.log("FakeFastq: Loading input bed...")
         self.bedfile = bedfile
         self.l.log("FakeFastq: Loading reference genome...")
-        self.reference = SeqIO.index(refpath, "fasta")
+        self.reference = Reference(refpath)
         self.readlen = readlen
         self.overlap = overlap
-        self.fqrecs = []
-
-        self.l.log("FakeFastq: Generating reads...")
-        self.build_recs()
+        self.quals = {}  #{read length: shared uniform quality string}
+        self.reads = 0  #number of reads written by save
 
     """
     Record Building
     """
 
     def build_recs(self):
-        """Iterates through the bedfile and populates fqrecs with 
-        FakeFastqRec objects corresponding to the bed regions"""
-        for bedline in self.bedfile:
+        """Generator over (recid, seq) for every read of every region
+        in the bedfile.  Record ids are prefixed with the region number so
+        they are unique across regions"""
+        for region, bedline in enumerate(self.bedfile):
             try:
-                chromseq = str(self.reference[bedline.chromosome].seq)
+                seq = self.reference.fetch(bedline.chromosome, bedline.start, bedline.end)
             except KeyError:
                 self.l.error("FakeFastq: Chromosome '"+bedline.chromosome+"' not found in reference fasta", 
                                 die=True, code=1)
-            seq = chromseq[bedline.start-1:bedline.end]
             self.l.log("FakeFastq: Building reads for "+str(bedline)[:-1]+"...")
-            self.build_reads(seq)
+            for recid, subseq in self.build_reads(seq):
+                yield ("g"+str(region+1)+"_"+recid, subseq)
         self.l.log("FakeFastq: Done with all regions")
     
     def build_reads(self, seq):
-        """Takes the sequence corresponding to the current bedfile in build_recs and populates
-        self.fqrecs with FakeFastqRec objects"""
+        """Generator over (recid, subseq) for the reads tiling seq, the
+        sequence corresponding to the current bedfile line in build_recs"""
         indx = 0  #current position in seq (reads start from here)
-        rid = 1  #current unique record id for building FakeFastqRec objects
+        rid = 1  #current unique record id
         window_incr = self.readlen - int(self.readlen*self.overlap)  #the amount to increase indx on each iteration
         while True:
             subseq = seq[indx:indx+self.readlen]  #a section of the sequence of readlen length
             if len(subseq) == 0:
                 break  #we've read the entire sequence and generated all necessary reads
-            #save a FakeFastqRec object with the subsequence and the next unique identifier
-            self.fqrecs.append(FakeFastqRec(subseq, "r"+str(rid)))
+            yield ("r"+str(rid), subseq)
             if len(subseq) < self.readlen:
                 break  #this is the last read
             rid += 1  #increment the unique record identifier
             indx += window_incr  #move the start of the next read
 
+    def qual(self, length):
+        """Returns the uniform high quality qual string for a read of length,
+        shared between all reads of that length"""
+        try:
+            return self.quals[length]
+        except KeyError:
+            self.quals[length] = "~"*length
+            return self.quals[length]
+
+    def fastq_recs(self):
+        """Generator over the four-line fastq text of every read"""
+        for recid, seq in self.build_recs():
+            yield "@"+recid+"\n"+seq+"\n+\n"+self.qual(len(seq))+"\n"
+
     """
     Saving reads
     """
 
     def save(self, outpath):
-        open(outpath, 'w').write(str(self))
+        """Generates the reads and writes them to outpath as they are built,
+        gzip-compressed if outpath ends in .gz.  The reference stays open,
+        so the reads can be saved again until close is called"""
+        if outpath.endswith(".gz"):
+            out = gzip.open(outpath, 'wt', compresslevel=GZIP_LEVEL)
+        else:
+            out = io.open(outpath, 'w', buffering=WRITE_BUFFER)
+        for rec in self.fastq_recs():
+            out.write(rec)
+            self.reads += 1
+        out.close()
         self.l.log("FakeFastq: All regions saved to "+outpath)
 
-    """
-    Operators
-    """
-
-    def __str__(self):
-        return ''.join([str(read) for read in self.fqrecs])
-
-class FakeFastqRec:
-    """A python representation of a simple fastq record containing the input
-    fake seq, a unique recid, and a fake uniform high quality qual string"""
-    def __init__(self, seq, recid):
-        """Stores the read seq and unique recid and generates the uniform
-        fake qual string"""
-        self.seq = seq
-        self.recid = recid
-        self.qual = "~"*len(self.seq)
+    def close(self):
+        """Closes the reference once no more reads are needed"""
+        self.reference.close()
 
     """
     Operators
     """
 
     def __str__(self):
-        """Returns the string representation of the FakeFastqRec - the four
-        lines with minimum data necessary to represent a fastq line"""
-        ret_s = ""
-        ret_s += "@"+self.recid+"\n"
-        ret_s += self.seq+"\n"
-        ret_s += "+\n"
-        ret_s += self.qual+"\n"
-        return ret_s
+        return ''.join(self.fastq_recs())
 
 if __name__ == "__main__":
     print("FakeFastq.py")
@@ -5,13 +5,13 @@ in the bedfile
 """
 
 #Global
-from Bio import SeqIO
 import sys
 
 #Repos
 import tools.formats.Bed as Bed
 
 #Local
+from Reference import Reference
 
 class FastaSubset:
     """A class that builds a representation of a FASTA file containing only regions
@@ -19,9 +19,10 @@ class FastaSubset:
     def __init__(self, fastapath, bed):
         self.fastapath = fastapath
         print("FastaSubset: Loading input fasta file...")
-        self.input_fasta = SeqIO.index(self.fastapath, "fasta")
+        self.input_fasta = Reference(self.fastapath)
         self.input_bed = bed
         self.lines = []
+        self.lifts = []  #[(record name, reference chrom, start, end, chrom length)]
         
         print("FastaSubset: Building subset fasta...")
         self.parse()
@@ -37,25 +38,18 @@ class FastaSubset:
         recid = 1
         for bedline in self.input_bed:
             chrom = bedline.chromosome
-            try:
-                seq = self.input_fasta[chrom].seq
-            except KeyError:  #likely naming convention, try a couple possibilities
-                if "chr" in chrom:  #check if input fasta convention is without chr
-                    try:
-                        seq = self.input_fasta[chrom.replace("chr", "")].seq
-                    except KeyError:
-                        print("ERROR: FastaSubset: Could not find "+chrom+" in "+self.fastapath)
-                        print("\tCouldn't find "+chrom.replace("chr", "")+" either.")
-                        sys.exit(1)
-                else:  #check if input fasta convention uses chr
-                    try:
-                        seq = self.input_fasta["chr"+chrom].seq
-                    except KeyError:
-                        print("ERROR: FastaSubset: Could not find "+chrom+" in "+self.fastapath)
-                        print("\tCoudln't find chr"+chrom+" either.")
-            self.lines.append(">"+chrom+"_"+str(recid)+'\n')  #make a new fasta header line
-            self.lines.append(str(seq[bedline.start-1:bedline.end])+'\n')  #make a new data line
+            try:  #the reference resolves chr/no-chr naming differences
+                ref_chrom = self.input_fasta.resolve(chrom)
+            except KeyError:
+                print("ERROR: FastaSubset: Could not find "+chrom+" in "+self.fastapath+" (with or without chr)")
+                sys.exit(1)
+            seq = self.input_fasta.fetch(ref_chrom, bedline.start, bedline.end)
+            name = chrom+"_"+str(recid)
+            self.lines.append(">"+name+'\n')  #make a new fasta header line
+            self.lines.append(seq+'\n')  #make a new data line
+            self.lifts.append((name, ref_chrom, bedline.start, bedline.end, self.input_fasta.length(ref_chrom)))
             recid += 1  #increment fasta record id for next record
+        self.input_fasta.close()
 
     """
     Saving parsed subsets
@@ -66,5 +60,12 @@ class FastaSubset:
         print("FastaSubset: Saving subset to "+outpath+"...")
         open(outpath, 'w').writelines(self.lines)
 
+    def save_lift(self, outpath):
+        """Writes a tab-separated table mapping each subset record back to
+        its reference chromosome, start, end and chromosome length, so
+        alignments to the subset can be lifted to genome coordinates"""
+        print("FastaSubset: Saving record coordinates to "+outpath+"...")
+        open(outpath, 'w').writelines(['\t'.join(map(str, lift))+'\n' for lift in self.lifts])
+
 if __name__ == "__main__":
     print("FastaSubset.py")
@@ -0,0 +1,148 @@
+"""
+This script defines a persistent on-disk store of homolog maps.  Homolog
+discovery (FakeFastq, the tile aligner and HomologMapping) only depends on the
+reference, the input regions and the tiling and alignment parameters, so
+its merged HomMaps are kept in a directory named after a checksum of the
+reference sequence, the tile aligner's index and those parameters.  Regions already in the store are answered
+with an interval lookup; only the missing regions are discovered, and their
+HomMaps are added to the store for later runs
+"""
+
+#Global
+import hashlib
+import json
+import os
+
+import numpy as np
+
+#Repos
+from tools.io.Log import Log
+
+#Local
+from Checkpoint import file_digest
+from HomologMapping import MergedMaps
+from IntervalIndex import IntervalIndex, Region, normalize_chrom
+from IntervalTable import IntervalTable
+
+CHECKSUM_SUFFIX = ".sha1"  #the reference checksum is cached in <reference>.sha1, next to its .fai
+
+class HomologDB:
+    """Homolog store for one reference and one set of discovery parameters,
+    under args.homolog_db/<key>/ with covered.bed (the regions discovered so
+    far), homologs.npz (the merged HomMap tables) and params.json"""
+    def __init__(self, args, readlen, overlap, filt_len, aligner):
+        """Takes the argparse object from hpileup, the FakeFastq readlen and
+        overlap and MergedMaps filt_len used for discovery and the Alignment
+        backend of the artificial reads, and loads the matching store if it
+        exists"""
+        self.args = args
+        self.filt_len = filt_len
+        self.l = Log()
+        self.params = {"reference": self.reference_checksum(), "readlen": readlen, "overlap": overlap,
+                        "filt_len": filt_len, "aligner": aligner.description(),
+                        "index": file_digest(aligner.index_file(aligner.default_index))}
+        self.key = hashlib.sha1(json.dumps(self.params, sort_keys=True).encode()).hexdigest()[:16]
+        self.dbdir = os.path.join(self.args.homolog_db, self.key)+"/"
+        self.covered = []  #[Region] regions whose homologs are in the store
+        self.mm = None  #MergedMaps of the stored HomMaps
+
+        self.load()
+
+    """
+    Store key
+    """
+
+    def reference_checksum(self):
+        """Returns the SHA-1 of the reference FASTA content, so references that
+        differ only in their bases (e.g. soft-masked or not) get different
+        stores.  The checksum is cached in <reference>.sha1 with the size and
+        modification time of the FASTA, and the genome is only read again
+        when those change"""
+        cache_path = self.args.ref+CHECKSUM_SUFFIX
+        stat = os.stat(self.args.ref)
+        if os.path.isfile(cache_path):
+            try:
+                cached = json.load(open(cache_path))
+                if cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+                    return cached["sha1"]
+            except (ValueError, KeyError):
+                pass
+        self.l.log("HomologDB: Computing the checksum of "+self.args.ref+"...")
+        sha = hashlib.sha1()
+        with open(self.args.ref, 'rb') as infile:
+            for block in iter(lambda: infile.read(1024*1024), b""):
+                sha.update(block)
+        cached = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": sha.hexdigest()}
+        try:
+            json.dump(cached, open(cache_path, 'w'))
+        except (IOError, OSError):
+            self.l.log("HomologDB: Could not save "+cache_path+", the checksum will be computed again next run")
+        return cached["sha1"]
+
+    """
+    Loading and saving
+    """
+
+    def load(self):
+        """Loads covered.bed and homologs.npz from self.dbdir, if present"""
+        if not os.path.isfile(self.dbdir+"homologs.npz"):
+            self.l.log("HomologDB: No homolog store at "+self.dbdir+" yet")
+            return
+        for line in open(self.dbdir+"covered.bed"):
+            chrom, start, end = line.strip('\n').split('\t')[:3]
+            self.covered.append(Region(chrom, int(start), int(end)))
+        self.mm = MergedMaps.load_tables(self.dbdir+"homologs.npz", filt_len=self.filt_len)
+        self.l.log("HomologDB: Loaded "+str(len(self.mm.table))+" homolog maps over "+
+                    str(len(self.covered))+" regions from "+self.dbdir)
+
+    def save(self):
+        """Writes the store to self.dbdir.  Files are written under temporary
+        names and moved into place so readers never see a partial store"""
+        if not os.path.exists(self.dbdir):
+            os.makedirs(self.dbdir)
+        index = IntervalIndex(self.covered)
+        outlines = []
+        for chrom in index.chromosomes():
+            outlines += [chrom+'\t'+str(start)+'\t'+str(end)+'\n' for start, end in index.regions(chrom)]
+        open(self.dbdir+"covered.bed.tmp", 'w').writelines(outlines)
+        json.dump(self.params, open(self.dbdir+"params.json", 'w'), indent=1, sort_keys=True)
+        self.mm.save_tables(self.dbdir+"homologs.npz")
+        os.replace(self.dbdir+"covered.bed.tmp", self.dbdir+"covered.bed")
+
+    """
+    Queries and updates
+    """
+
+    def missing(self, regions):
+        """Returns the bed lines of regions that are not entirely inside a
+        region already in the store"""
+        index = IntervalIndex(self.covered)
+        return [region for region in regions if not index.contains(region.chromosome, region.start, region.end)]
+
+    def add(self, regions, parts):
+        """Adds the MergedMaps parts discovered for regions to the store,
+        merging them with the stored HomMaps, and saves it"""
+        if len(regions) == 0:
+            return
+        stored = [self.mm] if self.mm != None else []
+        self.mm = MergedMaps(None, filt_len=self.filt_len, parts=stored+parts)
+        self.covered += [Region(region.chromosome, region.start, region.end) for region in regions]
+        self.l.log("HomologDB: Saving "+str(len(self.mm.table))+" homolog maps to "+self.dbdir)
+        self.save()
+
+    def lookup(self, regions):
+        """Returns a MergedMaps of the stored HomMaps whose input region
+        overlaps any of regions, or None if the store is empty"""
+        if self.mm == None:
+            return None
+        names = dict([(normalize_chrom(chrom), chrom) for chrom in self.mm.table.chroms])
+        queries = [(names[normalize_chrom(region.chromosome)], region.start, region.end) for region in regions
+                    if normalize_chrom(region.chromosome) in names]
+        mask = self.mm.table.overlapping(IntervalTable.from_tuples(queries, self.mm.table.chroms))
+        found = MergedMaps.from_tables(self.mm.table, self.mm.hom_table, self.mm.hom_offsets,
+                                        filt_len=self.filt_len)
+        found.take_rows(np.nonzero(mask)[0])
+        return found
+
+if __name__ == "__main__":
+    print("HomologDB.py")
@@ -0,0 +1,158 @@
+"""
+This script defines the homolog discovery stage of the pipeline.  For
+each chromosome of the input bed, artificial reads are tiled over its
+regions (FakeFastq), aligned back to the genome (Alignment) and merged
+into homolog maps (HomologMapping).  Chromosomes are independent, so
+they are processed in a pool of worker processes and their results are
+combined into ploidy.bed and input_homolog.bed
+
+Each step is checkpointed (see Checkpoint).  With --homolog_db, results are kept in a persistent HomologDB and only
+regions not yet in it are discovered
+"""
+
+#Global
+import concurrent.futures
+import copy
+import os
+
+#Repos
+from tools.formats.Bed import Bed
+from tools.io.Log import Log
+
+#Local
+import Alignment
+from Checkpoint import Checkpoint
+import FakeFastq
+from HomologDB import HomologDB
+import HomologMapping
+from Metrics import Stage
+
+FILT_LEN = 1000  #HomMaps this long or shorter are discarded
+READLEN = 1000  #length of the artificial reads
+OVERLAP = 0.75  #fraction of each artificial read shared with the next
+
+def discover_chrom(args, chrom):
+    """Runs FakeFastq, Alignment and HomologMapping on the regions of
+    chrom, read from args.outdir/homologs/<chrom>/input.bed, and returns
+    the merged and filtered MergedMaps.  Each step is skipped if its
+    checkpoint is still valid"""
+    workdir = args.outdir+"homologs/"+chrom+"/"
+    fq_path = workdir+"artificial_reads.fq"
+    sam_path = workdir+"artificial_aligned.sam"
+    tables_path = workdir+"homologs.npz"
+    l = Log()
+
+    ck = Checkpoint(args, "fakefastq:"+chrom, [workdir+"input.bed", args.ref], [fq_path],
+                    params={"readlen": READLEN, "overlap": OVERLAP})
+    if not ck.valid():
+        l.log("HomologDiscovery: Generating the artificial FASTQ file for chromosome "+chrom+"...")
+        with Stage(args, "fakefastq", sample=chrom) as stage:
+            ffq = FakeFastq.FakeFastq(Bed(workdir+"input.bed"), args.ref, readlen=READLEN, overlap=OVERLAP)
+            ffq.save(fq_path)
+            ffq.close()
+            stage.count("tiles", ffq.reads)
+        ck.done()
+
+    ##Run the tile aligner on the artificial reads
+    aligner = Alignment.backend(args, args.tile_aligner)
+    ck = Checkpoint(args, "alignment:"+chrom, [fq_path, aligner.index_file(aligner.default_index)], [sam_path],
+                    params={"aligner": aligner.description()}, tools=[aligner.tool])
+    if not ck.valid():
+        Alignment.Alignment(args, fq_path, sam_path, aligner=aligner)
+        ck.done()
+
+    ck = Checkpoint(args, "homolog-mapping:"+chrom, [sam_path, workdir+"input.bed"], [tables_path],
+                    params={"filt_len": FILT_LEN})
+    if ck.valid():
+        return HomologMapping.MergedMaps.load_tables(tables_path, filt_len=FILT_LEN)
+    with Stage(args, "homolog-mapping", sample=chrom) as stage:
+        l.log("HomologDiscovery: Compiling all homologous reads for chromosome "+chrom+"...")
+        qm = HomologMapping.QnameMaps(sam_path, workdir+"input.bed")
+        l.log("HomologDiscovery: Merging homologous reads for chromosome "+chrom+"...")
+        mm = HomologMapping.MergedMaps(qm, filt_len=FILT_LEN)
+        mm.save_tables(tables_path)
+        stage.count("reads", len(qm))
+        stage.count("hommaps_merged", mm.merged)
+        stage.count("hommaps_filtered", mm.filtered)
+        stage.count("hommaps", len(mm.table))
+    ck.done()
+    return mm
+
+class HomologDiscovery:
+    """Maps the homologs of every chromosome in the input bed, one worker
+    process per chromosome, and saves the combined results"""
+    def __init__(self, args, input_bed):
+        """Takes the argparse object from hpileup and the loaded input Bed
+        object, runs discovery on every chromosome and saves ploidy.bed and
+        input_homolog.bed to args.outdir.  With args.homolog_db, regions
+        found in the store are looked up instead of discovered"""
+        self.args = args
+        self.input_bed = input_bed
+        self.l = Log()
+        self.chroms = []  #chromosomes in input bed order
+        self.regions = [bedline for bedline in input_bed]  #regions to discover
+        self.db = None
+
+        if self.args.homolog_db != None:
+            aligner = Alignment.backend(self.args, self.args.tile_aligner)
+            self.db = HomologDB(self.args, READLEN, OVERLAP, FILT_LEN, aligner)
+            self.regions = self.db.missing(self.regions)
+            self.l.log("HomologDiscovery: "+str(len(self.regions))+" region(s) not in the homolog store")
+        self.split_bed()
+        self.parts = self.discover()  #[MergedMaps] of every chromosome
+        if self.db != None:
+            self.db.add(self.regions, self.parts)
+            found = self.db.lookup(self.input_bed)
+            self.parts = [found] if found != None else []
+        self.save()
+
+    """
+    Splitting the input by chromosome
+    """
+
+    def split_bed(self):
+        """Writes the lines of self.regions of each chromosome to
+        args.outdir/homologs/<chrom>/input.bed"""
+        lines = {}  #{chromosome: [bed line, ...]}
+        for bedline in self.regions:
+            if bedline.chromosome not in lines:
+                self.chroms.append(bedline.chromosome)
+                lines[bedline.chromosome] = []
+            lines[bedline.chromosome].append(str(bedline))
+        for chrom in self.chroms:
+            workdir = self.args.outdir+"homologs/"+chrom+"/"
+            if not os.path.exists(workdir):
+                os.makedirs(workdir)
+            open(workdir+"input.bed", 'w').writelines(lines[chrom])
+
+    """
+    Discovery
+    """
+
+    def discover(self):
+        """Runs discover_chrom on every chromosome, up to args.threads at a
+        time with the aligner threads split between them, and returns the
+        list of their MergedMaps"""
+        workers = max(1, min(len(self.chroms), self.args.threads))
+        chrom_args = copy.copy(self.args)
+        chrom_args.threads = max(1, self.args.threads//workers)
+        self.l.log("HomologDiscovery: Mapping homologs on "+str(len(self.chroms))+" chromosome(s), "+
+                    str(workers)+" at a time...")
+        if workers == 1:
+            return [discover_chrom(chrom_args, chrom) for chrom in self.chroms]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(discover_chrom, [chrom_args]*len(self.chroms), self.chroms))
+
+    """
+    Saving
+    """
+
+    def save(self):
+        """Combines the MergedMaps of all chromosomes and writes ploidy.bed and
+        input_homolog.bed, sorted by chromosome and start"""
+        self.l.log("HomologDiscovery: Saving ploidy info to "+self.args.outdir+"ploidy.bed")
+        mm = HomologMapping.MergedMaps(None, filt_len=FILT_LEN, parts=self.parts)
+        mm.save(self.args.outdir)
+
+if __name__ == "__main__":
+    print("HomologDiscovery.py")
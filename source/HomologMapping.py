@@ -7,6 +7,10 @@ See prototype in homolog_mapping3.ipynb
 """
 
 #Global
+import array
+import itertools
+import numpy as np
+import os
 import pysam
 
 #Repos
@@ -14,18 +18,51 @@ import tools.formats.Bed as Bed
 from tools.io.Log import Log
 
 #Local
+from IntervalIndex import IntervalIndex
+from IntervalTable import IntervalTable, INTERVAL_DTYPE
+
+def sweep_merge(items, merge):
+    """Merges a sorted list in one left-to-right sweep.  merge(a, b) returns
+    the merged item or None; a merged item is then compared with the next
+    item, so the result is the same as repeatedly merging neighbours"""
+    out = []
+    for item in items:
+        if len(out) > 0:
+            merged = merge(out[-1], item)
+            if merged != None:
+                out[-1] = merged
+                continue
+        out.append(item)
+    return out
 
 class QnameMaps:
     """Takes a SAM file as input and parses the reads into
-    a dictionary of the format
-    {qname: {"input": (chrom, start, end), "homs": [(chrom, start, end)]}}"""
+    a dictionary-like object of the format
+    {qname: {"input": (chrom, start, end), "homs": [(chrom, start, end)]}}
+
+    The alignments of each read must be grouped together, as the aligners
+    write them (or as samtools collate leaves them).  Entries are stored
+    in array columns indexed by row: integer chromosome ids, starts and
+    ends for the input alignment, and the homologous alignments of row i
+    at hom_offsets[i]:hom_offsets[i+1] of the hom_* columns"""
     def __init__(self, sampath, bedpath):
         """Loads the bed and sam and begins parsing according to the format above"""
         self.sampath = sampath
         self.bedpath = bedpath
         self.sam = pysam.AlignmentFile(self.sampath, mode='r')
         self.input_regions = Bed.Bed(self.bedpath)
-        self.maps = {}
+        self.input_index = IntervalIndex(self.input_regions)
+        self.l = Log()
+        self.chroms = []  #chromosome names, indexed by chromosome id
+        self.chrom_ids = {}  #{chromosome name: chromosome id}
+        self.rows = {}  #{qname: row}
+        self.input_chrom = array.array('i')
+        self.input_start = array.array('q')
+        self.input_end = array.array('q')
+        self.hom_offsets = array.array('q', [0])
+        self.hom_chrom = array.array('i')
+        self.hom_start = array.array('q')
+        self.hom_end = array.array('q')
 
         self.parse()
 
@@ -34,35 +71,85 @@ class QnameMaps:
     """
 
     def parse(self):
-        """Iterates through self.sam and populates self.maps"""
-        unmapped = []  #[(qname, chrom, start, end)]
-        for rec in self.sam.fetch():
-            chrom, start, end = rec.reference_name, rec.reference_start, rec.reference_end
-            qname = rec.query_name
-            try:
-                self.maps[qname]['homs'].append((chrom, start, end))
-            except KeyError:
-                if self.input_regions.overlap(chrom, start, end):
-                    self.maps[qname] = {"input": (chrom, start, end), "homs": []}
-                else:
-                    unmapped.append((qname, chrom, start, end))
-        for rec in unmapped:
-            qname, chrom, start, end = rec
-            try:
-                self.maps[qname]['homs'].append((chrom, start, end))
-                unmapped.remove(rec)
-            except KeyError:
-                pass
+        """Makes a single pass through self.sam, one read (qname) at a time,
+        and populates the map columns"""
+        seen = set()  #qnames already grouped
+        for qname, alns in itertools.groupby(self.alignments(), key=lambda aln: aln[0]):
+            if qname in seen:
+                self.l.error("QnameMaps: Alignments of "+qname+" in "+self.sampath+
+                                " are not grouped by read name (run samtools collate first)",
+                                die=True, code=1)
+            seen.add(qname)
+            self.add_read(qname, [aln[1:] for aln in alns])
+
+    def alignments(self):
+        """Generator over (qname, chrom, start, end) of every mapped record"""
+        for rec in self.sam.fetch(until_eof=True):
+            if rec.is_unmapped:
+                continue
+            yield (rec.query_name, rec.reference_name, rec.reference_start, rec.reference_end)
+
+    def add_read(self, qname, alns):
+        """Takes the [(chrom, start, end)] alignments of one read.  The first
+        alignment overlapping the input regions becomes the input alignment
+        and all others its homologs (those after it, then those before it).
+        Reads with no alignment in the input regions are dropped"""
+        for indx, aln in enumerate(alns):
+            if self.input_index.overlap(*aln):
+                break
+        else:
+            return
+        self.rows[qname] = len(self.input_chrom)
+        chrom, start, end = aln
+        self.input_chrom.append(self.chrom_id(chrom))
+        self.input_start.append(start)
+        self.input_end.append(end)
+        for chrom, start, end in alns[indx+1:]+alns[:indx]:
+            self.hom_chrom.append(self.chrom_id(chrom))
+            self.hom_start.append(start)
+            self.hom_end.append(end)
+        self.hom_offsets.append(len(self.hom_chrom))
+
+    def chrom_id(self, chrom):
+        """Returns the integer id of chrom, assigning a new one if needed"""
+        try:
+            return self.chrom_ids[chrom]
+        except KeyError:
+            self.chrom_ids[chrom] = len(self.chroms)
+            self.chroms.append(chrom)
+            return self.chrom_ids[chrom]
+
+    """
+    Row access
+    """
+
+    def input(self, row):
+        """Returns the (chrom, start, end) input alignment of row"""
+        return (self.chroms[self.input_chrom[row]], self.input_start[row], self.input_end[row])
+
+    def homs(self, row):
+        """Returns the [(chrom, start, end)] homologous alignments of row"""
+        return [(self.chroms[self.hom_chrom[indx]], self.hom_start[indx], self.hom_end[indx])
+                for indx in range(self.hom_offsets[row], self.hom_offsets[row+1])]
+
+    def entries(self):
+        """Generator over (input, homs) for every read, in file order"""
+        for row in range(len(self.input_chrom)):
+            yield (self.input(row), self.homs(row))
 
     """
     Operators
     """
 
     def __getitem__(self, key):
-        return self.maps[key]
+        row = self.rows[key]
+        return {"input": self.input(row), "homs": self.homs(row)}
+
+    def __len__(self):
+        return len(self.rows)
 
     def keys(self):
-        return self.maps.keys()
+        return self.rows.keys()
 
 class HomMap:
     """This class represents a single input region and a set of homologous regions"""
@@ -126,39 +213,23 @@ class HomMap:
         """Given a list [(chrom, start, end)], sorts and merges the records
         such that they are increasing alphabetically by chromosome and internally
         by start, and none are directly adjacent or overlapping"""
-        rec_l = homs
-        if len(rec_l) <= 1:
-            return rec_l
-        rec_l = self.homs_sort(rec_l)
-        indx = 0
-        while True:
-            merged = self.merge(rec_l[indx], rec_l[indx+1])
-            if len(merged) == 2:
-                indx += 1
-            else:
-                rec_l = rec_l[:indx]+merged+rec_l[indx+2:]
-            if indx == len(rec_l)-1:
-                break
-        return rec_l
+        if len(homs) <= 1:
+            return homs
+        return sweep_merge(self.homs_sort(homs), self.merge_recs)
         
     def homs_sort(self, homs):
         """Takes a list [(chrom, start, end)] and returns the list sorted overall
-        by alphabetically-increasing chrom and internally by increasing start"""
-        rec_d = {}  #{chromosome: [(chromosome, start, end), ...]}
-        #populate rec_d
-        for rec in homs:
-            if rec[0] in rec_d.keys():
-                rec_d[rec[0]].append(rec)
-            else:
-                rec_d[rec[0]] = [rec]
-        #internally sort every list in rec_d by start coordinate
-        for chrom in rec_d.keys():
-            rec_d[chrom] = sorted(rec_d[chrom], key=lambda x: x[1])
-        #rebuild a list by sorting the keys (chromosomes) of rec_d
-        out_l = []
-        for chrom in sorted(rec_d.keys()):
-            out_l += rec_d[chrom]
-        return out_l
+        by alphabetically-increasing chrom and internally by increasing start.
+        The sort is stable, and concatenations of already sorted lists (as in
+        can_merge) are merged in linear time"""
+        return sorted(homs, key=lambda rec: (rec[0], rec[1]))
+
+    def merge_recs(self, rec1, rec2):
+        """Returns the merge of rec1 and rec2, or None if they do not merge"""
+        merged = self.merge(rec1, rec2)
+        if len(merged) == 1:
+            return merged[0]
+        return None
     
     def merge(self, rec1, rec2):
         """Checks if rec1 and rec2 overlap - checks if chromosomes match and
@@ -174,71 +245,240 @@ class MergedMaps:
     """This class takes in a QnameMaps object and
     initlializes a set of HomMap objects with each individual entry
     from the QnameMaps object and performs merging according to the rules
-    listed above"""
-    def __init__(self, qm, filt_len=1000):
-        """Saves the qm and calls HomMap loading functions and merging functions"""
-        self.qm = qm
+    listed above
+
+    The HomMaps are stored in IntervalTables: self.table holds the input
+    region of every HomMap and self.hom_table the homologous regions, those
+    of row i at hom_offsets[i]:hom_offsets[i+1].  Sorting, merging,
+    filtering and saving work on whole columns; hom_maps returns HomMap
+    views of the rows"""
+    def __init__(self, qm, filt_len=1000, parts=None):
+        """Loads the entries of qm and calls the merging and filtering
+        functions.  If parts (a list of MergedMaps, e.g. merged per
+        chromosome or loaded from a HomologDB) is given, their rows are
+        combined and merged instead of the entries of qm"""
         self.filt_len = filt_len
-        self.hms = []
+        self.table = None  #IntervalTable of input regions, one row per HomMap
+        self.hom_table = None  #IntervalTable of the homologous regions of all rows
+        self.hom_offsets = None  #numpy array, len(self.table)+1 offsets into self.hom_table
+        self.merged = 0  #number of HomMaps merged into a neighbour
+        self.filtered = 0  #number of HomMaps removed by hm_filter
         
-        self.load_hms()
+        if parts != None:
+            self.concat(parts)
+        else:
+            self.load_hms(qm)
         self.merge()
         self.hm_filter()
-        
+
+    @classmethod
+    def from_tables(cls, table, hom_table, hom_offsets, filt_len=1000):
+        """Returns a MergedMaps holding tables that are already merged and
+        filtered (e.g. loaded from a HomologDB), without merging them again"""
+        mm = cls.__new__(cls)
+        mm.filt_len = filt_len
+        mm.table = table
+        mm.hom_table = hom_table
+        mm.hom_offsets = hom_offsets
+        mm.merged = 0
+        mm.filtered = 0
+        return mm
+
+    @classmethod
+    def load_tables(cls, path, filt_len=1000):
+        """Returns a MergedMaps with the tables written by save_tables"""
+        data = np.load(path, allow_pickle=False)
+        chroms = data["chroms"].tolist()
+        return cls.from_tables(IntervalTable(chroms, data["inputs"]), IntervalTable(chroms, data["homs"]),
+                                data["offsets"], filt_len=filt_len)
+
+    """
+    HomMap views
+    """
+
+    def hom_maps(self):
+        """Returns the rows as a list of HomMap objects"""
+        homs = list(zip(self.hom_table.names().tolist(), self.hom_table.rows["start"].tolist(),
+                        self.hom_table.rows["end"].tolist()))
+        offsets = self.hom_offsets.tolist()
+        hms = []
+        for indx, (chrom, start, end) in enumerate(zip(self.table.names().tolist(),
+                                                        self.table.rows["start"].tolist(),
+                                                        self.table.rows["end"].tolist())):
+            hms.append(HomMap(chrom, start, end, homs[offsets[indx]:offsets[indx+1]]))
+        return hms
+
+    def hom_map(self, row):
+        """Returns row as a HomMap with chromosome ids in place of names, which
+        sort the same way, for HomMap.can_merge"""
+        rec = self.table.rows[row]
+        homs = self.hom_table.rows[self.hom_offsets[row]:self.hom_offsets[row+1]]
+        return HomMap(int(rec["chrom"]), int(rec["start"]), int(rec["end"]),
+                        list(zip(homs["chrom"].tolist(), homs["start"].tolist(), homs["end"].tolist())))
+
+    def run_map(self, first, last):
+        """Returns the HomMap (with chromosome ids) that the tiling run of
+        rows first..last merges into: the input region and every hom span
+        from their start in row first to their end in row last"""
+        hm = self.hom_map(first)
+        hm.end = int(self.table.rows["end"][last])
+        ends = self.hom_table.rows["end"][self.hom_offsets[last]:self.hom_offsets[last+1]].tolist()
+        hm.homs = [(chrom, start, end) for (chrom, start, _), end in zip(hm.homs, ends)]
+        return hm
+
     """
     HomMap loading
     """
     
-    def load_hms(self):
-        """Parses each entry of self.qm into a HomMap object
-        and populates self.hms"""
-        for qname in self.qm.keys():
-            chrom, start, end = self.qm[qname]['input']
-            if chrom != "7":  #Debug
-                continue  #Debug
-            homs = self.qm[qname]['homs']
-            self.hms.append(HomMap(chrom, start, end, homs))
+    def load_hms(self, qm):
+        """Loads the columns of the QnameMaps qm into the tables, with the
+        homs of every row sorted once (kept sorted by merging)"""
+        chroms = sorted(qm.chroms)
+        self.table = IntervalTable.from_columns(qm.chroms, qm.input_chrom, qm.input_start,
+                                                qm.input_end, chroms)
+        hom_table = IntervalTable.from_columns(qm.chroms, qm.hom_chrom, qm.hom_start,
+                                                qm.hom_end, chroms)
+        self.hom_offsets = np.asarray(qm.hom_offsets, dtype=np.int64)
+        owners = np.repeat(np.arange(len(self.table)), np.diff(self.hom_offsets))
+        order = np.lexsort((hom_table.rows["start"], hom_table.rows["chrom"], owners))
+        self.hom_table = hom_table.take(order)
+
+    def concat(self, parts):
+        """Sets the tables to the rows of the MergedMaps parts, in order, with
+        their chromosome ids mapped to the sorted union of their chroms"""
+        chroms = sorted(set([chrom for mm in parts for chrom in mm.table.chroms]))
+        rows, homs = [np.zeros(0, dtype=INTERVAL_DTYPE)], [np.zeros(0, dtype=INTERVAL_DTYPE)]
+        for mm in parts:
+            remap = np.array([chroms.index(chrom) for chrom in mm.table.chroms], dtype=np.int32)
+            for table, out in [(mm.table, rows), (mm.hom_table, homs)]:
+                part = table.rows.copy()
+                part["chrom"] = remap[part["chrom"]]
+                out.append(part)
+        counts = np.concatenate([np.zeros(0, dtype=np.int64)]+[np.diff(mm.hom_offsets) for mm in parts])
+        self.table = IntervalTable(chroms, np.concatenate(rows))
+        self.hom_table = IntervalTable(chroms, np.concatenate(homs))
+        self.hom_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    def take_rows(self, indices):
+        """Keeps only the rows at indices (in that order), along with their homs"""
+        counts = np.diff(self.hom_offsets)[indices]
+        firsts = self.hom_offsets[:-1][indices]
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        hom_indices = (np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts) +
+                        np.repeat(firsts, counts))
+        self.table = self.table.take(indices)
+        self.hom_table = self.hom_table.take(hom_indices)
+        self.hom_offsets = offsets
             
     """
     Merging
     """
     
     def merge(self):
-        """Iteratively updates self.hms until it can no longer
-        be reduced according to the 3 rules above"""
-        self.hms = self.sort(self.hms)
-        hms = self.hms[:]
-        if len(hms) == 1:
-            return hms
-        indx = 0
-        while True:
-            new_hms = hms[indx].can_merge(hms[indx+1])
-            if new_hms == None:
-                indx += 1
-            else:
-                hms = hms[:indx]+[new_hms]+hms[indx+2:]
-            if indx == len(hms)-1:
-                break
-        self.hms = hms
-        
+        """Merges neighbouring rows by the rules of HomMap.can_merge, applied
+        in one sweep over the rows sorted by chromosome and start.  Runs of
+        rows that tile a region, with homs that tile their homologous
+        regions one to one, are merged with column operations; the rows of
+        any other overlap cluster go through HomMap.can_merge"""
+        self.take_rows(self.table.sort_order())
+        count = len(self.table)
+        if count > 1:
+            self.merge_sorted()
+        self.merged += count-len(self.table)
+
+    def tiling_runs(self):
+        """Splits the sorted rows into tiling runs, where every row starts
+        after the row before it, ends no earlier and overlaps it, and its
+        k-th hom does the same with the k-th hom of that row.  Returns the
+        first row of every run, the run of every row and a boolean array
+        marking the runs whose merged homs would reach the next hom of
+        their first row (these do not merge hom by hom)"""
+        rows, homs = self.table.rows, self.hom_table.rows
+        counts = np.diff(self.hom_offsets)
+        owners = np.repeat(np.arange(len(rows)), counts)
+        kth = np.arange(len(homs))-self.hom_offsets[:-1][owners]
+        joins = np.zeros(len(rows), dtype=bool)
+        joins[1:] = ((rows["chrom"][1:] == rows["chrom"][:-1]) & (counts[1:] == counts[:-1]) &
+                        (rows["start"][1:] > rows["start"][:-1]) & (rows["end"][1:] >= rows["end"][:-1]) &
+                        (rows["end"][:-1] >= rows["start"][1:]))
+        cur = np.nonzero(joins[owners])[0]
+        prev = cur-counts[owners[cur]]
+        tiles = ((homs["chrom"][cur] == homs["chrom"][prev]) & (homs["start"][cur] >= homs["start"][prev]) &
+                    (homs["end"][cur] >= homs["end"][prev]) & (homs["end"][prev] >= homs["start"][cur]))
+        joins[owners[cur[~tiles]]] = False
+        firsts = np.nonzero(~joins)[0]
+        run_ids = np.cumsum(~joins)-1
+
+        ##the k-th hom of a run must end before the (k+1)-th hom of its first row starts
+        first_homs = self.hom_offsets[:-1][firsts[run_ids[owners]]]+kth
+        inner = np.nonzero(kth < counts[owners]-1)[0]
+        nexts = first_homs[inner]+1
+        reach = inner[(homs["chrom"][nexts] == homs["chrom"][first_homs[inner]]) &
+                        (homs["end"][inner] >= homs["start"][nexts])]
+        irregular = np.zeros(len(firsts), dtype=bool)
+        irregular[run_ids[owners[reach]]] = True
+        irregular &= np.diff(np.append(firsts, len(rows))) > 1
+        return firsts, run_ids, irregular
+
+    def merge_sorted(self):
+        """Merges the sorted rows: every tiling run becomes one row, except in
+        the overlap clusters (see IntervalTable.clusters) holding an irregular
+        run or a row that merges with the run before it by HomMap.can_merge.
+        Those clusters are swept with can_merge instead"""
+        rows, homs = self.table.rows, self.hom_table.rows
+        counts = np.diff(self.hom_offsets)
+        firsts, run_ids, irregular = self.tiling_runs()
+        lasts = np.append(firsts[1:]-1, len(rows)-1)
+        clusters = self.table.clusters()
+        swept = np.zeros(clusters[-1]+1, dtype=bool)  #clusters merged by can_merge
+        swept[clusters[firsts[irregular]]] = True
+
+        ##a row that starts a run may still merge with the whole run before it
+        starts, ends = firsts[1:], lasts[:-1]
+        near = starts[(rows["chrom"][starts] == rows["chrom"][ends]) & (counts[starts] == counts[ends]) &
+                        ((rows["end"][ends] >= rows["start"][starts]) |
+                            (rows["start"][starts] == rows["start"][firsts[:-1]]))]
+        for row in near.tolist():
+            if not swept[clusters[row]]:
+                hm = self.run_map(firsts[run_ids[row-1]], row-1)
+                swept[clusters[row]] = hm.can_merge(self.hom_map(row)) != None
+
+        ##runs outside the swept clusters: the input region and homs span from the first row to the last
+        keep = np.nonzero(~swept[clusters[firsts]])[0]
+        run_firsts, run_lasts = firsts[keep], lasts[keep]
+        run_counts = counts[run_firsts]
+        kth = np.arange(run_counts.sum())-np.repeat(np.cumsum(run_counts)-run_counts, run_counts)
+        out_rows = [rows[run_firsts]]
+        out_rows[0]["end"] = rows["end"][run_lasts]
+        out_homs = [homs[np.repeat(self.hom_offsets[run_firsts], run_counts)+kth]]
+        out_homs[0]["end"] = homs["end"][np.repeat(self.hom_offsets[run_lasts], run_counts)+kth]
+        out_counts = [run_counts]
+        positions = [run_firsts]
+
+        ##rows of the swept clusters, as (first row, HomMap) items
+        items = [(row, self.hom_map(row)) for row in np.nonzero(swept[clusters])[0].tolist()]
+        items = sweep_merge(items, self.merge_items)
+        out_rows.append(np.array([(hm.chrom, hm.start, hm.end) for _, hm in items], dtype=INTERVAL_DTYPE))
+        out_homs.append(np.array([hom for _, hm in items for hom in hm.homs], dtype=INTERVAL_DTYPE))
+        out_counts.append(np.array([len(hm.homs) for _, hm in items], dtype=np.int64))
+        positions.append(np.array([row for row, _ in items], dtype=np.int64))
+
+        self.table = IntervalTable(self.table.chroms, np.concatenate(out_rows))
+        self.hom_table = IntervalTable(self.hom_table.chroms, np.concatenate(out_homs))
+        self.hom_offsets = np.concatenate(([0], np.cumsum(np.concatenate(out_counts)))).astype(np.int64)
+        self.take_rows(np.argsort(np.concatenate(positions), kind="stable"))
+
+    def merge_items(self, item1, item2):
+        """sweep_merge function over (first row, HomMap) items"""
+        merged = item1[1].can_merge(item2[1])
+        if merged == None:
+            return None
+        return (item1[0], merged)
+
     def sort(self, hm_l):
         """Takes a list of HomMap objects and sorts them according to 
-        alphabetical chromosome and then increasing start position"""
-        hm_d = {}  #{chromosome: [HomMap]}
-        #populate hm_d
-        for hm in hm_l:
-            if hm.chrom in hm_d.keys():
-                hm_d[hm.chrom].append(hm)
-            else:
-                hm_d[hm.chrom] = [hm]
-        #internally sort every list in hm_d by start coordinate
-        for chrom in hm_d.keys():
-            hm_d[chrom] = sorted(hm_d[chrom], key=lambda x: x.start)
-        #rebuild a list by sorting the keys (chromosomes) of hm_d
-        out_l = []
-        for chrom in sorted(hm_d.keys()):
-            out_l += hm_d[chrom]
-        return out_l
+        alphabetical chromosome and then increasing start position (stable)"""
+        return sorted(hm_l, key=lambda hm: (hm.chrom, hm.start))
     
     """
     Filtering
@@ -247,33 +487,38 @@ class MergedMaps:
     def hm_filter(self):
         """If any HMs are equal to or shorter than self.filt_len,
         remove them from the results"""
-        self.hms = filter(lambda x: x.end-x.start > self.filt_len, self.hms)
+        count = len(self.table)
+        self.take_rows(np.nonzero(self.table.lengths() > self.filt_len)[0])
+        self.filtered += count-len(self.table)
     
     """
     Saving to bed file
     """
     
     def save(self, outdir):
-        """Writes self.hms post-merge to a bed file"""
+        """Writes the merged rows to ploidy.bed and input_homolog.bed in outdir"""
         ##saving ploidy
-        outlines = []
-        for hm in self.hms:
-            outlines.append('\t'.join(map(str, [hm.chrom, hm.start, hm.end, len(hm.homs)]))+'\n')
-        open(outdir+"ploidy.bed", 'w').writelines(outlines)
-        ##saving input+homologous bed
-        all_hms = []
-        for hm in self.hms:
-            all_hms.append(hm)
-            all_hms += [HomMap(hom[0], hom[1], hom[2], []) for hom in hm.homs]
-        all_hms = self.sort(all_hms)
-        outlines = []
-        for hm in all_hms:
-            outlines.append('\t'.join(map(str, [hm.chrom, hm.start, hm.end]))+'\n')
-        open(outdir+"input_homolog.bed", 'w').writelines(outlines)
+        counts = np.diff(self.hom_offsets)
+        open(outdir+"ploidy.bed", 'w').writelines(self.table.bed_lines(counts))
+        ##saving input+homologous bed, each input followed by its homs before sorting
+        rows = np.empty(len(self.table)+len(self.hom_table), dtype=INTERVAL_DTYPE)
+        rows[np.arange(len(self.table))+self.hom_offsets[:-1]] = self.table.rows
+        rows[np.arange(len(self.hom_table))+np.repeat(np.arange(len(self.table)), counts)+1] = self.hom_table.rows
+        all_table = IntervalTable(self.table.chroms, rows)
+        open(outdir+"input_homolog.bed", 'w').writelines(all_table.take(all_table.sort_order()).bed_lines())
+
+    def save_tables(self, path):
+        """Writes the tables to the .npz file path, so they can be loaded
+        again with load_tables.  The file is written under a temporary name
+        and moved into place"""
+        with open(path+".tmp", 'wb') as out:
+            np.savez(out, chroms=np.array(self.table.chroms, dtype=str), inputs=self.table.rows,
+                        homs=self.hom_table.rows, offsets=self.hom_offsets)
+        os.replace(path+".tmp", path)
 
 if __name__ == "__main__":
     print("HomologMapping.py")
     qm = QnameMaps("PMS2/artificial_aligned.sam", "PMS2/PMS2_input.bed")
     mm = MergedMaps(qm, filt_len=1000)
-    for hm in mm.hms:
+    for hm in mm.hom_maps():
         print(hm.chrom, hm.start, hm.end, hm.homs)
@@ -0,0 +1,108 @@
+"""
+This script defines an index over the regions of a BED file that
+answers overlap queries with a binary search instead of a scan over
+every region.  Chromosome naming differences (chr7 vs 7) are resolved
+once when the index is built
+"""
+
+#Global
+import bisect
+
+#Repos
+from tools.formats.Bed import Bed
+
+#Local
+
+def normalize_chrom(chrom):
+    """Returns chrom without a leading 'chr' so that both naming
+    conventions map to the same key"""
+    if chrom.startswith("chr"):
+        return chrom[3:]
+    return chrom
+
+class Region:
+    """A bed-line-like region with chromosome, start and end"""
+    def __init__(self, chromosome, start, end):
+        self.chromosome = chromosome
+        self.start = start
+        self.end = end
+
+class IntervalIndex:
+    """Per-chromosome index of merged BED regions stored as sorted
+    start and end lists"""
+    def __init__(self, bed):
+        """Takes a Bed object (or a path to a BED file, or any iterable of
+        bed lines) and builds the index"""
+        if isinstance(bed, str):
+            bed = Bed(bed)
+        self.starts = {}  #{normalized chrom: [start, ...]}
+        self.ends = {}  #{normalized chrom: [end, ...]}
+        self.names = {}  #{normalized chrom: chromosome name as written in the bed}
+
+        self.build(bed)
+
+    """
+    Index building
+    """
+
+    def build(self, bed):
+        """Groups the bed regions by chromosome, sorts them by start and
+        merges overlapping regions so that each chromosome holds disjoint,
+        increasing intervals"""
+        regions = {}  #{normalized chrom: [(start, end), ...]}
+        for region in bed:
+            key = normalize_chrom(region.chromosome)
+            self.names.setdefault(key, region.chromosome)
+            regions.setdefault(key, []).append((region.start, region.end))
+        for key in regions.keys():
+            starts, ends = [], []
+            for start, end in sorted(regions[key]):
+                if len(ends) > 0 and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.starts[key] = starts
+            self.ends[key] = ends
+
+    """
+    Queries
+    """
+
+    def overlap(self, chrom, start, end):
+        """Returns True if the closed interval [start, end] on chrom
+        overlaps any indexed region"""
+        key = normalize_chrom(chrom)
+        try:
+            starts = self.starts[key]
+        except KeyError:
+            return False
+        indx = bisect.bisect_right(starts, end)-1  #last region starting at or before end
+        return indx >= 0 and self.ends[key][indx] >= start
+
+    def contains(self, chrom, start, end):
+        """Returns True if the closed interval [start, end] on chrom lies
+        entirely within one indexed region"""
+        key = normalize_chrom(chrom)
+        try:
+            starts = self.starts[key]
+        except KeyError:
+            return False
+        indx = bisect.bisect_right(starts, start)-1  #last region starting at or before start
+        return indx >= 0 and self.ends[key][indx] >= end
+
+    def regions(self, chrom):
+        """Returns the merged [(start, end)] regions for chrom"""
+        key = normalize_chrom(chrom)
+        return list(zip(self.starts.get(key, []), self.ends.get(key, [])))
+
+    def chromosomes(self):
+        """Returns the indexed chromosome names as written in the bed"""
+        return [self.names[key] for key in sorted(self.starts.keys())]
+
+    def merged(self):
+        """Returns the merged regions of every chromosome as Region objects"""
+        return [Region(chrom, start, end) for chrom in self.chromosomes() for start, end in self.regions(chrom)]
+
+if __name__ == "__main__":
+    print("IntervalIndex.py")
@@ -0,0 +1,135 @@
+"""
+This script defines an array-backed table of genomic intervals.  Each
+interval is a row of a NumPy structured array holding an integer
+chromosome id, a start and an end.  Chromosome ids follow the
+alphabetical order of the chromosome names, so sorting by id sorts
+chromosomes the same way the rest of the pipeline does, and sorting,
+filtering, overlap queries and BED formatting work on whole columns
+"""
+
+#Global
+import numpy as np
+
+#Repos
+
+#Local
+
+INTERVAL_DTYPE = np.dtype([("chrom", np.int32), ("start", np.int64), ("end", np.int64)])
+POS_SPAN = 1 << 40  #positions are below POS_SPAN, so chrom*POS_SPAN+pos orders rows across chromosomes
+
+class IntervalTable:
+    """A set of (chrom, start, end) intervals stored as a structured array,
+    with self.chroms mapping chromosome ids to names"""
+    def __init__(self, chroms, rows):
+        """chroms is the sorted list of chromosome names and rows a structured
+        array of INTERVAL_DTYPE whose chrom column indexes chroms"""
+        self.chroms = chroms
+        self.rows = rows
+
+    @classmethod
+    def from_tuples(cls, recs, chroms=None):
+        """Builds a table from a list of (chrom, start, end) tuples.  If
+        chroms (a sorted list of names including every chrom in recs) is not
+        given, it is built from recs"""
+        if chroms == None:
+            chroms = sorted(set([rec[0] for rec in recs]))
+        chrom_ids = dict([(chrom, indx) for indx, chrom in enumerate(chroms)])
+        rows = np.array([(chrom_ids[chrom], start, end) for chrom, start, end in recs],
+                        dtype=INTERVAL_DTYPE)
+        return cls(chroms, rows)
+
+    @classmethod
+    def from_columns(cls, names, chrom_ids, starts, ends, chroms=None):
+        """Builds a table from columns, where chrom_ids index the (unsorted)
+        list names.  Ids are remapped so the table's chroms are sorted"""
+        if chroms == None:
+            chroms = sorted(names)
+        remap = np.array([chroms.index(name) for name in names], dtype=np.int32)
+        rows = np.empty(len(starts), dtype=INTERVAL_DTYPE)
+        rows["chrom"] = remap[np.asarray(chrom_ids, dtype=np.int64)] if len(remap) > 0 else 0
+        rows["start"] = starts
+        rows["end"] = ends
+        return cls(chroms, rows)
+
+    """
+    Column operations
+    """
+
+    def sort_order(self):
+        """Returns the stable order of rows by chromosome, then start"""
+        return np.lexsort((self.rows["start"], self.rows["chrom"]))
+
+    def take(self, indices):
+        """Returns a new table with the rows at indices (or a boolean mask)"""
+        return IntervalTable(self.chroms, self.rows[indices])
+
+    def lengths(self):
+        """Returns end-start of every row"""
+        return self.rows["end"]-self.rows["start"]
+
+    def overlaps(self, chrom, start, end):
+        """Returns a boolean mask of the rows overlapping the closed
+        interval [start, end] on chrom"""
+        if chrom not in self.chroms:
+            return np.zeros(len(self.rows), dtype=bool)
+        chrom_id = self.chroms.index(chrom)
+        return ((self.rows["chrom"] == chrom_id) & (self.rows["start"] <= end) &
+                (self.rows["end"] >= start))
+
+    def keys(self, column):
+        """Returns chrom*POS_SPAN+column of every row, so one sorted search
+        over the keys is a search within each chromosome"""
+        return self.rows["chrom"].astype(np.int64)*POS_SPAN+self.rows[column]
+
+    def clusters(self):
+        """Returns the cluster id of every row of a table sorted by
+        sort_order: rows overlapping each other (directly or through other
+        rows, as closed intervals) share an id, and ids increase with the rows"""
+        if len(self.rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        reach = np.maximum.accumulate(self.keys("end"))
+        breaks = np.ones(len(self.rows), dtype=bool)
+        breaks[1:] = self.keys("start")[1:] > reach[:-1]
+        return np.cumsum(breaks)-1
+
+    def overlapping(self, other):
+        """Returns a boolean mask of the rows overlapping any row of other (a
+        table with the same chroms) as closed intervals.  The rows of other
+        are merged into disjoint intervals and each row is looked up with
+        a binary search on their starts"""
+        if len(self.rows) == 0 or len(other) == 0:
+            return np.zeros(len(self.rows), dtype=bool)
+        other = other.take(other.sort_order())
+        starts, reach = other.keys("start"), np.maximum.accumulate(other.keys("end"))
+        breaks = np.ones(len(other), dtype=bool)
+        breaks[1:] = starts[1:] > reach[:-1]
+        ends = reach[np.append(np.nonzero(breaks)[0][1:]-1, len(other)-1)]
+        found = np.searchsorted(starts[breaks], self.keys("end"), side="right")-1
+        return (found >= 0) & (ends[np.maximum(found, 0)] >= self.keys("start"))
+
+    def names(self):
+        """Returns the chromosome name of every row"""
+        if len(self.rows) == 0:
+            return np.array([], dtype=str)
+        return np.array(self.chroms)[self.rows["chrom"]]
+
+    def tuple_at(self, indx):
+        """Returns row indx as a (chrom, start, end) tuple of Python values"""
+        row = self.rows[indx]
+        return (self.chroms[row["chrom"]], int(row["start"]), int(row["end"]))
+
+    def bed_lines(self, *columns):
+        """Returns the rows as tab-separated BED lines, with any extra
+        columns (arrays of the same length) appended"""
+        if len(self.rows) == 0:
+            return []
+        lines = self.names()
+        for column in [self.rows["start"], self.rows["end"]]+list(columns):
+            lines = np.char.add(np.char.add(lines, '\t'), np.asarray(column).astype(str))
+        return [line+'\n' for line in lines.tolist()]
+
+    def __len__(self):
+        return len(self.rows)
+
+if __name__ == "__main__":
+    print("IntervalTable.py")
@@ -0,0 +1,219 @@
+"""
+This script defines per-stage instrumentation for the pipeline.  A Stage
+measures the wall time, CPU time, peak memory and bytes read and written
+of a block of work and of the tool subprocesses it waits for, along with
+any record counts the stage reports.  Figures of the stage's own Python
+code and of its subprocesses are kept in separate fields, as they are
+measured differently.  Every finished stage appends one JSON line to
+args.outdir/metrics.jsonl, from any thread or worker process, and
+write_report combines them into run_report.json next to ploidy.bed
+"""
+
+#Global
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+
+#Repos
+
+#Local
+
+METRICS_FILE = "metrics.jsonl"  #per-stage records, appended during the run
+REPORT_FILE = "run_report.json"  #combined report written at the end of the run
+USAGE_SCOPE = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)  #CPU of the calling thread where supported
+RSS_SAMPLE_INTERVAL = 0.05  #seconds between samples of this process's memory during a stage
+PAGE_KB = os.sysconf("SC_PAGE_SIZE")//1024
+
+def io_counters():
+    """Returns (bytes read, bytes written) by the calling thread from
+    /proc/thread-self/io, or (0, 0) where it is not available"""
+    counters = {}
+    try:
+        for line in open("/proc/thread-self/io"):
+            key, value = line.split(':')
+            counters[key] = int(value)
+    except (IOError, OSError, ValueError):
+        return (0, 0)
+    return (counters.get("rchar", 0), counters.get("wchar", 0))
+
+def current_rss(pid="self"):
+    """Returns the resident set size (KB) of process pid (this process by
+    default) from /proc/<pid>/statm, or 0 where it is not available"""
+    try:
+        return int(open("/proc/"+str(pid)+"/statm").read().split()[1])*PAGE_KB
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+
+def tree_rss(pid):
+    """Returns the summed resident set size (KB) of process pid and all of
+    its descendants, e.g. the tools of a shell pipeline"""
+    total = 0
+    pids = [pid]
+    while len(pids) > 0:
+        pid = pids.pop()
+        total += current_rss(pid)
+        try:
+            for tid in os.listdir("/proc/"+str(pid)+"/task"):
+                pids += [int(child) for child in open("/proc/"+str(pid)+"/task/"+tid+"/children").read().split()]
+        except (IOError, OSError, ValueError):
+            continue  #exited, or no children list on this kernel
+    return total
+
+def reset(args):
+    """Removes the metrics of an earlier run in args.outdir"""
+    if os.path.exists(args.outdir+METRICS_FILE):
+        os.remove(args.outdir+METRICS_FILE)
+
+class Stage:
+    """Context manager recording the resource use of one stage:
+
+        with Stage(args, "alignment", sample=sample_path) as stage:
+            stage.call(cmd)
+            stage.count("reads", n)
+
+    Subprocesses started with call or popen are measured:
+    child_peak_rss_kb is the largest summed memory of their process trees
+    sampled while they ran (the maximum RSS reported by the kernel for a
+    child includes that of its parent before exec, so it is not used), and
+    CPU time and child_block_read/written_bytes, their block I/O, which
+    leaves out reads served from the page cache, are added when they are
+    waited for.  CPU time and read_bytes/written_bytes
+    (all read and write calls, cached or not) of the stage's own Python
+    code are those of the calling thread.  rss_kb is the largest memory of
+    the whole process sampled while the stage ran, so concurrent stages in
+    other threads are included"""
+    def __init__(self, args, name, sample=None):
+        """name is the stage name and sample the sample (or chromosome,
+        region...) it ran on"""
+        self.args = args
+        self.record = {"stage": name, "sample": sample, "pid": os.getpid(), "counts": {}}
+        self.child_cpu = 0.0
+        self.child_rss = 0  #peak RSS (KB) of the waited subprocesses
+        self.child_read = 0
+        self.child_written = 0
+        self.rss = 0  #largest sampled RSS (KB) of this process during the stage
+        self.procs = []  #pids of the running subprocesses started by the stage
+        self.sampled = threading.Event()  #set when the stage ends
+        self.sampler = threading.Thread(target=self.sample_rss, daemon=True)
+
+    def __enter__(self):
+        self.start = time.time()
+        self.start_usage = resource.getrusage(USAGE_SCOPE)
+        self.start_io = io_counters()
+        self.rss = current_rss()
+        self.sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        usage = resource.getrusage(USAGE_SCOPE)
+        end_io = io_counters()
+        self.sampled.set()
+        self.sampler.join()
+        cpu = (usage.ru_utime-self.start_usage.ru_utime)+(usage.ru_stime-self.start_usage.ru_stime)
+        self.record.update({"status": "ok" if exc_type == None else "failed",
+                            "start": self.start,
+                            "wall_s": round(time.time()-self.start, 3),
+                            "cpu_s": round(cpu+self.child_cpu, 3),
+                            "rss_kb": max(self.rss, current_rss()),
+                            "child_peak_rss_kb": self.child_rss,
+                            "read_bytes": end_io[0]-self.start_io[0],
+                            "written_bytes": end_io[1]-self.start_io[1],
+                            "child_block_read_bytes": self.child_read,
+                            "child_block_written_bytes": self.child_written})
+        self.save()
+        return False
+
+    def sample_rss(self):
+        """Samples the RSS of this process every RSS_SAMPLE_INTERVAL seconds
+        until the stage ends (runs in self.sampler)"""
+        while not self.sampled.wait(RSS_SAMPLE_INTERVAL):
+            self.rss = max(self.rss, current_rss())
+            self.child_rss = max(self.child_rss, sum([tree_rss(pid) for pid in list(self.procs)]))
+
+    """
+    Subprocesses and counts
+    """
+
+    def popen(self, cmd, **kwargs):
+        """Starts the shell command cmd with subprocess.Popen (kwargs are
+        passed on) and samples its memory until it is waited for.  Returns
+        the Popen object, which must be waited for with wait"""
+        proc = subprocess.Popen(cmd, shell=True, **kwargs)
+        self.procs.append(proc.pid)
+        return proc
+
+    def wait(self, proc):
+        """Waits for the subprocess.Popen proc, adds its resource use (and
+        that of the processes it waited for, e.g. the tools of a shell
+        pipeline) to the stage and returns its exit code"""
+        pid, status, usage = os.wait4(proc.pid, 0)
+        if proc.pid in self.procs:
+            self.procs.remove(proc.pid)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        self.child_cpu += usage.ru_utime+usage.ru_stime
+        self.child_read += usage.ru_inblock*512
+        self.child_written += usage.ru_oublock*512
+        return proc.returncode
+
+    def call(self, cmd):
+        """Runs the shell command cmd, like subprocess.call, and returns its
+        exit code"""
+        return self.wait(self.popen(cmd))
+
+    def count(self, key, n=1):
+        """Adds n to the record count key (e.g. reads kept)"""
+        self.record["counts"][key] = self.record["counts"].get(key, 0)+n
+
+    """
+    Saving
+    """
+
+    def save(self):
+        """Appends the record to args.outdir/metrics.jsonl as one write, so
+        records of concurrent stages do not interleave"""
+        line = (json.dumps(self.record, sort_keys=True)+'\n').encode()
+        try:
+            fd = os.open(self.args.outdir+METRICS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        except (IOError, OSError):
+            return  #output directory not there (yet), nothing to record to
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+def write_report(args):
+    """Writes args.outdir/run_report.json with every stage record and, per
+    stage name, the number of runs and their summed times, bytes and counts
+    and the largest RSS and subprocess peak RSS"""
+    records = []
+    if os.path.exists(args.outdir+METRICS_FILE):
+        records = [json.loads(line) for line in open(args.outdir+METRICS_FILE) if line.strip() != ""]
+    summary = {}  #{stage name: totals}
+    for record in records:
+        totals = summary.setdefault(record["stage"], {"runs": 0, "failed": 0, "wall_s": 0.0, "cpu_s": 0.0,
+                                                        "rss_kb": 0, "child_peak_rss_kb": 0,
+                                                        "read_bytes": 0, "written_bytes": 0,
+                                                        "child_block_read_bytes": 0,
+                                                        "child_block_written_bytes": 0, "counts": {}})
+        totals["runs"] += 1
+        totals["failed"] += int(record["status"] != "ok")
+        for key in ["wall_s", "cpu_s", "read_bytes", "written_bytes", "child_block_read_bytes",
+                    "child_block_written_bytes"]:
+            totals[key] += record[key]
+        for key in ["rss_kb", "child_peak_rss_kb"]:
+            totals[key] = max(totals[key], record[key])
+        for key in record["counts"].keys():
+            totals["counts"][key] = totals["counts"].get(key, 0)+record["counts"][key]
+    for totals in summary.values():
+        totals["wall_s"] = round(totals["wall_s"], 3)
+        totals["cpu_s"] = round(totals["cpu_s"], 3)
+    report = {"created": time.time(), "args": dict([(key, str(value)) for key, value in vars(args).items()]),
+                "summary": summary, "stages": records}
+    json.dump(report, open(args.outdir+REPORT_FILE, 'w'), indent=1, sort_keys=True)
+    return report
+
+if __name__ == "__main__":
+    print("Metrics.py")
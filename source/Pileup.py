@@ -5,85 +5,100 @@ pipeline.  See pileup2.ipynb for prototype/reference
 
 #Global
 import subprocess
+import threading
 
 #Repos
 from tools.io.Log import Log
 
 #Local
-from Alignment import Alignment
+from Alignment import Alignment, backend
+from Checkpoint import Checkpoint
+from Metrics import Stage
 from SamRegionFilter import SamRegionFilter as SRF
+from SubsetReference import SubsetReference
+
+COLLATE_SHARE = 4  #samtools collate gets 1/COLLATE_SHARE of the threads when streaming
+
+def pileup_sample(args, sample_path):
+    """Runs the pileup steps for a single sample (TaskGraph entry point)"""
+    Pileup(args).process_sample(sample_path)
 
 class Pileup:
-    """Takes any number of SAM/BAM files and uses samtools and Bowtie2
-    to collapse all reads from various homologous regions to the
-    user supplied input regions"""
+    """Takes any number of SAM/BAM/CRAM files and uses samtools and the read
+    aligner (Bowtie 2 or BWA-MEM) to collapse all reads from various
+    homologous regions to the user supplied input regions"""
     def __init__(self, args):
-        """Iterates through the args.samples (sam/bam files) and implements collapsing
-        of all reads from homologous regions onto the user input regions.
-        args is the argparse object from hpileup.py"""
+        """Sets up the collapsing of all reads from homologous regions onto
+        the user input regions.  args is the argparse object from hpileup.py.
+        Samples (sam/bam/cram files) are processed one at a time by
+        process_sample"""
         self.args = args
         self.l = Log()
-        
-        self.run()
+        self.aligner = backend(self.args, self.args.read_aligner)
+        self.subset = None  #homolog-only reference, if realigning against it
+        self.fed_reads = 0  #reads read by the streaming pipeline's feeder thread
+        self.feed_error = None  #exception raised in the feeder thread, re-raised by stream_realign
+        if self.args.subset_ref:
+            self.subset = SubsetReference(self.args)
 
     """
     Pipeline driver
     """
 
-    def run(self):
-        """Calls the pipeline steps for each file in self.sam_paths"""
-        self.l.log("Piling up reads from the input SAM/BAM files...")
-        for sample_path in self.args.samples:
-            self.l.log("Pileup: Processing "+sample_path+"...")
-            ##convert from bam to sam if needed
-            sample_path = self.check_for_bam(sample_path)
-            outbase = ".".join(sample_path.split('.')[:-1])
-
-            ##Filter out regions that are not in input or homologous regions
-            self.keep_input_homolog(outbase)
-
-            ##Revert to FASTQ
-            self.revert(outbase)
-
-            ##Realign filtered to all
-            self.realign(outbase)
-
-            ##Filter to only input regions
-            self.keep_input(outbase)
-
-    """
-    BAM -> SAM
-    """
-
-    def check_for_bam(self, sambam_path):
-        """Checks if the input file is a bam file.  If so, convert it and return
-        a new path, otherwise return the input path"""
-        if sambam_path.split('.')[-1] == ".bam":
-            self.l.log("Converting "+sample_path+" to uncompressed SAM format...")
-            return bam2sam(sambam_path)
-        return sambam_path
-
-    def bam2sam(self, bam_path):
-        """Converts a BAM file to SAM. Saves the result in the same
-        directory as the BAM input.  Returns the path to the new SAM file"""
-        outpath = '.'.join(bam_path.split('.')[:-1])+'.sam'
-        samtools = self.args.samtools_loc
-        cmd = samtools+" view -h -o "+outpath+" "+bam_path
-        subprocess.call(cmd, shell=True)
-        return outpath
+    def process_sample(self, sample_path):
+        """Calls the pipeline steps for a single sam/bam/cram file, unless
+        its checkpoint is still valid"""
+        outbase = ".".join(sample_path.split('.')[:-1])
+        ck = self.checkpoint(sample_path, outbase)
+        if ck.valid():
+            return
+        self.l.log("Pileup: Processing "+sample_path+"...")
+
+        with Stage(self.args, "pileup", sample=sample_path):
+            if self.args.stream:
+                ##Filter, revert, realign and filter again through pipes
+                self.stream_realign(sample_path, outbase)
+            else:
+                ##Filter out regions that are not in input or homologous regions
+                self.keep_input_homolog(sample_path, outbase)
+
+                ##Revert to FASTQ
+                self.revert(outbase)
+
+                ##Realign filtered to all
+                self.realign(outbase)
+
+                ##Filter to only input regions
+                self.keep_input(outbase)
+        ck.done()
+
+    def checkpoint(self, sample_path, outbase):
+        """Returns the Checkpoint of the pileup steps for sample_path"""
+        index = self.subset.index_path if self.subset != None else self.aligner.default_index
+        inputs = [sample_path, self.args.outdir+"input_homolog.bed", self.args.outdir+"input.bed",
+                    self.args.ref, self.aligner.index_file(index)]
+        if self.subset != None:
+            inputs.append(self.subset.lift_path)
+        return Checkpoint(self.args, "pileup:"+sample_path, inputs, [outbase+"_realigned_input.sam"],
+                            params={"stream": self.args.stream, "subset_ref": self.args.subset_ref,
+                                    "aligner": self.aligner.description()},
+                            tools=[self.args.samtools_loc, self.aligner.tool])
 
     """
     Filtering functions
     """
 
-    def keep_input_homolog(self, outbase):
-        """Takes a path to a sam file and filters it so that only the regions
-        in the input and homologous regions are kept"""
-        sampath = outbase+".sam"
+    def keep_input_homolog(self, sampath, outbase):
+        """Takes a path to a sam, bam or cram file and filters it so that only
+        the regions in the input and homologous regions are kept.  Bam/cram
+        files are read directly, without conversion to sam"""
         self.l.log("Filtering "+sampath+" to contain reads in input or homlogs...")
         input_hom_bed_path = self.args.outdir+"input_homolog.bed"
-        srf = SRF(sampath, input_hom_bed_path)
-        srf.save(outbase+"_input-homolog.sam")
+        with Stage(self.args, "filter-input-homolog", sample=sampath) as stage:
+            srf = SRF(sampath, input_hom_bed_path, outpath=outbase+"_input-homolog.sam",
+                        reference=self.args.ref)
+            stage.count("reads_seen", srf.reads_seen)
+            stage.count("reads_kept", srf.reads_kept)
 
     def keep_input(self, outbase):
         """Takes a path to a sam file and filters it so that only the regions
@@ -91,8 +106,18 @@ class Pileup:
         sampath = outbase+"_input-homolog_realigned.sam"
         self.l.log("Filtering "+sampath+" to contain reads in input regions only...")
         input_bed_path = self.args.outdir+"input.bed"
-        srf = SRF(sampath, input_bed_path)
-        srf.save(outbase+"_realigned_input.sam")
+        with Stage(self.args, "filter-input", sample=sampath) as stage:
+            srf = SRF(self.realigned_lines(open(sampath)), input_bed_path,
+                        outpath=outbase+"_realigned_input.sam")
+            stage.count("reads_seen", srf.reads_seen)
+            stage.count("reads_kept", srf.reads_kept)
+
+    def realigned_lines(self, samfile):
+        """Returns the lines of a realigned sam stream in genome coordinates,
+        lifting them if reads were aligned to the homolog-only reference"""
+        if self.subset == None:
+            return samfile
+        return self.subset.lift_lines(samfile)
 
     """
     Revert SAM --> FASTQ
@@ -107,24 +132,93 @@ class Pileup:
         fastq_out = outbase+"_input-homolog.fq"
         self.l.log("Reverting "+sampath+" to FASTQ...")
 
-        cmd = samtools+" collate -u -n 1 -l 1 --output-fmt SAM "+sampath+" "+collated_out
+        cmd = samtools+" collate -@ "+str(max(0, self.args.threads-1))  #-@ counts extra threads
+        cmd += " -u -n 1 -l 1 --output-fmt SAM "+sampath+" "+collated_out
         self.l.log(cmd)
-        subprocess.call(cmd, shell=True)
+        with Stage(self.args, "samtools-collate", sample=sampath) as stage:
+            stage.call(cmd)
 
         cmd = samtools+" fastq "+collated_out+".sam > "+fastq_out
         self.l.log(cmd)
-        subprocess.call(cmd, shell=True)
+        with Stage(self.args, "samtools-fastq", sample=sampath) as stage:
+            stage.call(cmd)
 
     """
     Alignment wrapper
     """
 
     def realign(self, outbase):
-        """Calls the Alignment class, which calls Bowtie2 to realign reads"""
+        """Calls the Alignment class, which calls the read aligner to realign reads"""
         input_fq = outbase+"_input-homolog.fq"
         output_sam = outbase+"_input-homolog_realigned.sam"
-        self.l.log("Aligning "+input_fq+ " to the genome (output at "+output_sam+")...")
-        Alignment(self.args, input_fq, output_sam)
+        if self.subset == None:
+            self.l.log("Aligning "+input_fq+ " to the genome (output at "+output_sam+")...")
+            Alignment(self.args, input_fq, output_sam, aligner=self.aligner)
+        else:
+            self.l.log("Aligning "+input_fq+ " to the homolog-only reference (output at "+output_sam+")...")
+            Alignment(self.args, input_fq, output_sam, ref=self.subset.index_path, aligner=self.aligner)
+
+    """
+    Streaming pipeline
+    """
+
+    def stream_threads(self):
+        """Returns the (collate, aligner) thread counts of the streaming
+        pipeline, where both tools run at once and share args.threads"""
+        collate = max(1, self.args.threads//COLLATE_SHARE)
+        return collate, max(1, self.args.threads-collate)
+
+    def stream_realign(self, sampath, outbase):
+        """Runs keep_input_homolog, revert, realign and keep_input as one
+        pipeline.  The input/homolog filter writes into samtools collate,
+        which feeds samtools fastq and the aligner through pipes, and the
+        aligner's output is read directly by the input-region filter, so
+        only the final _realigned_input.sam is written"""
+        samtools = self.args.samtools_loc
+        ref = None if self.subset == None else self.subset.index_path
+        collate_threads, aligner_threads = self.stream_threads()
+        aligner = Alignment(self.args, "-", "-", run=False, ref=ref, aligner=self.aligner,
+                            threads=aligner_threads)
+        cmd = samtools+" collate -@ "+str(collate_threads-1)  #-@ counts extra threads
+        cmd += " -O -u -n 1 -l 1 - "+outbase+"_input-homolog_collated"
+        cmd += " | "+samtools+" fastq -"
+        cmd += " | "+aligner.cmd()
+        self.l.log("Streaming "+sampath+" through the realignment pipeline...")
+        self.l.log("\t"+cmd)
+        input_bed_path = self.args.outdir+"input.bed"
+        with Stage(self.args, "stream-realign", sample=sampath) as stage:
+            proc = stage.popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+
+            ##the homolog filter runs in its own thread so that the pipeline's
+            ##output can be consumed while its input is still being written
+            feeder = threading.Thread(target=self.feed_pipeline, args=(sampath, proc.stdin))
+            feeder.start()
+            srf = SRF(self.realigned_lines(self.aligner.sam_lines(proc.stdout)), input_bed_path,
+                        outpath=outbase+"_realigned_input.sam")
+            feeder.join()
+            proc.stdout.close()
+            code = stage.wait(proc)
+            if self.feed_error != None:
+                raise self.feed_error  #the pipeline saw a truncated input
+            stage.count("reads_seen", self.fed_reads)
+            stage.count("reads_realigned", srf.reads_seen)
+            stage.count("reads_kept", srf.reads_kept)
+        if code != 0:
+            self.l.error("Pileup: Realignment pipeline failed for "+sampath, die=True, code=1)
+
+    def feed_pipeline(self, sampath, stream):
+        """Writes the reads of sampath in input or homolog regions to stream,
+        then closes it so the next pipeline stage sees end of input.  Any
+        exception is kept in self.feed_error for stream_realign"""
+        self.feed_error = None
+        try:
+            srf = SRF(sampath, self.args.outdir+"input_homolog.bed", outpath=stream,
+                        reference=self.args.ref)
+            self.fed_reads = srf.reads_seen
+        except BaseException as e:
+            self.feed_error = e
+        finally:
+            stream.close()
 
 if __name__ == "__main__":
     print("Pileup.py")
@@ -0,0 +1,162 @@
+"""
+This script defines random access to a reference FASTA file through
+its samtools-style .fai index.  The FASTA is memory-mapped and only the
+bases of a requested region are read, instead of a whole chromosome.
+Recently read fixed-size windows of sequence are cached and queries are
+sliced out of them.  The index is built next to the FASTA if it does not
+exist yet
+"""
+
+#Global
+import collections
+import mmap
+import os
+
+#Repos
+from tools.io.Log import Log
+
+#Local
+from IntervalIndex import normalize_chrom
+
+WINDOW_SIZE = 65536  #bases per cached window; windows start at multiples of this
+CACHE_WINDOWS = 16  #number of recently used windows kept in memory
+
+class Reference:
+    """Memory-mapped reference FASTA with .fai-based region fetches and
+    chr/no-chr chromosome name resolution"""
+    def __init__(self, fastapath, cache_size=CACHE_WINDOWS, window_size=WINDOW_SIZE):
+        """Loads (or builds) the .fai index of fastapath and maps the file.
+        Call close() when done with it"""
+        self.fastapath = fastapath
+        self.fai_path = fastapath+".fai"
+        self.cache_size = cache_size
+        self.window_size = window_size
+        self.entries = collections.OrderedDict()  #{name: (length, offset, line bases, line width)}
+        self.aliases = {}  #{normalized name: name in the fasta}
+        self.cache = collections.OrderedDict()  #{(name, window number): seq}, least recently used first
+        self.l = Log()
+
+        if not os.path.isfile(self.fai_path):
+            self.build_fai()
+        else:
+            self.load_fai()
+        self.fasta = open(self.fastapath, 'rb')
+        self.data = mmap.mmap(self.fasta.fileno(), 0, access=mmap.ACCESS_READ)
+
+    """
+    Index loading/building
+    """
+
+    def load_fai(self):
+        """Reads the .fai index into self.entries"""
+        for line in open(self.fai_path):
+            name, length, offset, linebases, linewidth = line.strip('\n').split('\t')[:5]
+            self.add_entry(name, (int(length), int(offset), int(linebases), int(linewidth)))
+
+    def build_fai(self):
+        """Scans the FASTA once to build its .fai index, saving it next to the
+        FASTA when the directory is writable"""
+        self.l.log("Reference: Indexing "+self.fastapath+"...")
+        name, length, offset, linebases, linewidth = None, 0, 0, 0, 0
+        pos = 0  #byte position in the file
+        for line in open(self.fastapath, 'rb'):
+            if line[:1] == b">":
+                if name != None:
+                    self.add_entry(name, (length, offset, linebases, linewidth))
+                name = line[1:].split()[0].decode()
+                length, offset, linebases, linewidth = 0, pos+len(line), 0, 0
+            else:
+                bases = len(line.rstrip(b"\r\n"))
+                if linebases == 0:
+                    linebases, linewidth = bases, len(line)
+                length += bases
+            pos += len(line)
+        if name != None:
+            self.add_entry(name, (length, offset, linebases, linewidth))
+        outlines = [name+'\t'+'\t'.join(map(str, entry))+'\n' for name, entry in self.entries.items()]
+        try:
+            open(self.fai_path, 'w').writelines(outlines)
+        except (IOError, OSError):
+            self.l.log("Reference: Could not save "+self.fai_path+", keeping the index in memory")
+
+    def add_entry(self, name, entry):
+        """Stores an index entry and its chr/no-chr alias"""
+        self.entries[name] = entry
+        self.aliases.setdefault(normalize_chrom(name), name)
+
+    """
+    Queries
+    """
+
+    def resolve(self, chrom):
+        """Returns the name used in the FASTA for chrom, accepting either the
+        chr-prefixed or the bare name.  Raises KeyError if neither exists"""
+        if chrom in self.entries:
+            return chrom
+        return self.aliases[normalize_chrom(chrom)]
+
+    def length(self, chrom):
+        """Returns the length of chrom"""
+        return self.entries[self.resolve(chrom)][0]
+
+    def chromosomes(self):
+        """Returns the chromosome names in FASTA order"""
+        return list(self.entries.keys())
+
+    def fetch(self, chrom, start, end):
+        """Returns the bases of chrom from start to end (1-based, inclusive,
+        as bed lines are used in this pipeline), clipped to the chromosome.
+        The bases are sliced out of the cached windows the region falls in;
+        regions spanning more windows than the cache holds are read directly.
+        Raises KeyError if chrom is not in the reference"""
+        name = self.resolve(chrom)
+        start0, end0 = max(0, start-1), min(self.entries[name][0], end)  #0-based, half-open
+        if end0 <= start0:
+            return ""
+        first, last = start0//self.window_size, (end0-1)//self.window_size
+        if last-first+1 > self.cache_size:
+            return self.read(name, start0, end0)
+        seq = ''.join([self.window(name, indx) for indx in range(first, last+1)])
+        offset = first*self.window_size
+        return seq[start0-offset:end0-offset]
+
+    def window(self, name, indx):
+        """Returns window number indx of chromosome name from the cache,
+        reading it if needed"""
+        key = (name, indx)
+        try:
+            seq = self.cache.pop(key)
+        except KeyError:
+            start0 = indx*self.window_size
+            seq = self.read(name, start0, min(self.entries[name][0], start0+self.window_size))
+        self.cache[key] = seq
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return seq
+
+    def read(self, name, start0, end0):
+        """Slices the bases from start0 to end0 (0-based, half-open, within
+        the chromosome) of chromosome name out of the mapped FASTA"""
+        length, offset, linebases, linewidth = self.entries[name]
+        first = offset + (start0//linebases)*linewidth + start0%linebases
+        last = offset + ((end0-1)//linebases)*linewidth + (end0-1)%linebases
+        raw = self.data[first:last+1]
+        if linewidth != linebases:
+            raw = raw.replace(b"\n", b"").replace(b"\r", b"")
+        return raw.decode()
+
+    def close(self):
+        """Unmaps the FASTA and closes it"""
+        self.cache.clear()
+        self.data.close()
+        self.fasta.close()
+
+    def __contains__(self, chrom):
+        try:
+            self.resolve(chrom)
+            return True
+        except KeyError:
+            return False
+
+if __name__ == "__main__":
+    print("Reference.py")
@@ -2,27 +2,73 @@
 This script defines a class to take a SAM file and BED
 file as input and filter the SAM file such that it only contains
 reads that start and/or end within regions defined in the bed file
+
+BAM/CRAM files are read directly with pysam.  Coordinate-sorted files
+with an index are read only over the bed regions through the index rather
+than scanned from start to end
 """
 
 #Global
+import io
+import pysam
 
 #Repos
 import tools.io.file_iterator as file_iterator
 from tools.formats.Bed import Bed
 
 #Local
+from IntervalIndex import IntervalIndex
+
+STREAM_BUFFER = 1024*1024  #write buffer size (bytes) for streamed output
+
+def open_alignment(path, reference=None):
+    """Opens a BAM or CRAM file with pysam.  reference is the FASTA path,
+    which CRAM files need for decoding"""
+    if path.endswith(".cram"):
+        return pysam.AlignmentFile(path, 'rc', reference_filename=reference)
+    return pysam.AlignmentFile(path, 'rb')
+
+def is_binary(path):
+    """Returns True if path is a BAM or CRAM file rather than SAM text"""
+    return path.endswith((".bam", ".cram"))
+
+def has_index(path, reference=None):
+    """Returns True if path is a BAM or CRAM file with an index that
+    SamRegionFilter can use for region fetches"""
+    if not is_binary(path):
+        return False
+    aln = open_alignment(path, reference)
+    indexed = aln.has_index()
+    aln.close()
+    return indexed
 
 class SamRegionFilter:
     """This class filters an input SAM file such that it will only contain reads that start
     and/or end within regions of the input Bed file"""
-    def __init__(self, sampath, bedpath):
-        """Loads the input sampath and bedpath and starts filtering"""
+    def __init__(self, sampath, bedpath, outpath=None, reference=None):
+        """Loads the input sampath and bedpath and starts filtering.  If outpath
+        is given, passing lines are streamed there through a buffered writer
+        instead of being held in self.samlines, so memory use does not grow
+        with the size of the input.  reference is the FASTA path used to
+        decode CRAM input.
+
+        sampath may also be an open SAM text stream (or any iterable of SAM
+        lines) and outpath an open writable stream, so the filter can sit
+        inside a pipe"""
         self.sampath = sampath
         self.bedpath = bedpath
+        self.outpath = outpath
+        self.reference = reference
         self.bed = Bed(bedpath)
+        self.index = IntervalIndex(self.bed)
         self.samlines = []
+        self.reads_seen = 0  #alignments read from the input
+        self.reads_kept = 0  #alignments that passed the filter
 
-        self.filter_sam()
+        if self.outpath == None:
+            self.filter_sam()
+        else:
+            self.stream_sam()
 
     """
     Filtering reads
@@ -32,35 +78,99 @@ class SamRegionFilter:
         """Iterates through the input sam file and saves any lines
         that pass filters - that is, they either partially or fully overlap
         with the input bed regions"""
-        for line in file_iterator.iterate(open(self.sampath)):
+        for line in self.passing_lines():
+            self.samlines.append(line)
+
+    def stream_sam(self):
+        """Writes every line that passes filters to self.outpath in a
+        single pass over the input"""
+        if not isinstance(self.outpath, str):
+            self.outpath.writelines(self.passing_lines())
+            return
+        with io.open(self.outpath, 'w', buffering=STREAM_BUFFER) as out:
+            for line in self.passing_lines():
+                out.write(line)
+
+    def passing_lines(self):
+        """Returns a generator over the header lines of the input and the
+        alignment lines that overlap the input bed regions"""
+        if not isinstance(self.sampath, str):
+            return self.scanned_lines()
+        if has_index(self.sampath, self.reference):
+            return self.fetched_lines()
+        if is_binary(self.sampath):
+            return self.scanned_records()
+        return self.scanned_lines()
+
+    def header_text(self, aln):
+        """Returns the SAM text header of an open pysam AlignmentFile"""
+        header = str(aln.header)
+        if len(header) > 0 and header[-1] != '\n':
+            header += '\n'
+        return header
+
+    def fetched_lines(self):
+        """Generator over the SAM text of the header and of every read
+        overlapping the bed regions, fetched through the BAM/CRAM index.
+        The index merges overlapping bed regions, so a read is only seen
+        twice when it spans neighbouring regions; those reads are skipped
+        on the second region"""
+        aln = open_alignment(self.sampath, self.reference)
+        yield self.header_text(aln)
+        for contig in aln.references:
+            prev_end = None  #end of the previous region fetched on contig
+            for start, end in self.index.regions(contig):
+                for rec in aln.fetch(contig, start-1, end):
+                    self.reads_seen += 1
+                    if prev_end != None and rec.reference_start < prev_end:
+                        continue  #overlaps the previous region, already written
+                    self.reads_kept += 1
+                    yield rec.to_string()+'\n'
+                prev_end = end
+        aln.close()
+
+    def scanned_records(self):
+        """Generator over the SAM text of the header and of every read of an
+        unindexed BAM/CRAM file that overlaps the bed regions.  Records are
+        decoded one at a time, so no SAM copy of the input is written"""
+        aln = open_alignment(self.sampath, self.reference)
+        yield self.header_text(aln)
+        for rec in aln.fetch(until_eof=True):
+            self.reads_seen += 1
+            if rec.reference_name == None:
+                continue  #unplaced read
+            start = rec.reference_start+1
+            end = start + rec.query_length
+            if self.overlaps_bed(rec.reference_name, start, end):
+                self.reads_kept += 1
+                yield rec.to_string()+'\n'
+        aln.close()
+
+    def scanned_lines(self):
+        """Generator over the header lines of the input sam file and the
+        alignment lines that overlap the input bed regions"""
+        if isinstance(self.sampath, str):
+            lines = file_iterator.iterate(open(self.sampath))
+        else:
+            lines = self.sampath
+        for line in lines:
             if line[0] == "@":
-                self.samlines.append(line)
+                yield line
                 continue
-            linevals = line.strip('\n').split('\t')
+            self.reads_seen += 1
+            linevals = line.split('\t', 10)
             chrom = linevals[2]
-            if "chr" not in chrom:
-                chrom = "chr"+chrom
             start = int(linevals[3])
             readlen = len(linevals[9])
             end = start + readlen
             if self.overlaps_bed(chrom, start, end):
-                self.samlines.append(line)
-            
+                self.reads_kept += 1
+                yield line
+
     def overlaps_bed(self, chrom, start, end):
         """Checks if the supplied chromosome, start, and end
         positions overlap with self.bed"""
-        for region in self.bed:
-            bed_chrom = region.chromosome
-            if "chr" not in bed_chrom:
-                bed_chrom = "chr"+bed_chrom
-            bed_start = region.start
-            bed_end = region.end
-            if chrom != bed_chrom:
-                continue
-            if start > bed_end or end < bed_start:
-                continue
-            return True
-        return False
+        return self.index.overlap(chrom, start, end)
     
     """
     Saving filtered SAM lines
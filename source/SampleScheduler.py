@@ -0,0 +1,59 @@
+"""
+This script defines the per-sample settings of the pipeline stages that
+run several samples at once as tasks of a TaskGraph.  The --threads
+budget is split between the concurrent samples, and each sample's output
+goes to its own log file
+"""
+
+#Global
+import os
+import sys
+
+#Repos
+from tools.io.Log import Log
+
+#Local
+
+def run_logged(fn, args, sample_path, logpath):
+    """Calls fn(args, sample_path) with stdout and stderr, including the
+    output of any tools it calls, redirected to logpath"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = (os.dup(1), os.dup(2))
+    logfile = open(logpath, 'a')
+    os.dup2(logfile.fileno(), 1)
+    os.dup2(logfile.fileno(), 2)
+    try:
+        fn(args, sample_path)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+        logfile.close()
+
+class SampleScheduler:
+    """Splits args.threads between up to args.parallel_samples samples in
+    flight and names their log files"""
+    def __init__(self, args, stage):
+        """Takes the argparse object from hpileup and the name of the stage
+        being run (used to name the per-sample log files)"""
+        self.args = args
+        self.stage = stage
+        self.l = Log()
+        self.workers = max(1, min(self.args.parallel_samples, len(self.args.samples)))
+        self.sample_threads = max(1, self.args.threads//self.workers)
+
+    """
+    Scheduling
+    """
+
+    def log_path(self, sample_path):
+        """Returns the path of the log file for sample_path in this stage"""
+        outbase = ".".join(os.path.basename(sample_path).split('.')[:-1])
+        return self.args.outdir+"logs/"+outbase+"."+self.stage+".log"
+
+if __name__ == "__main__":
+    print("SampleScheduler.py")
@@ -2,52 +2,326 @@
 This script defines a class to call GATK on a SAM file
 assuming that different regions of the file have different ploidies.
 The class uses ploidy information from previous pipeline steps
+
+Region jobs (one per ploidy region and sample) run concurrently as tasks
+of the sample TaskGraph (see hpileup), longest regions first.  With
+--batch_ploidy, regions that share a ploidy are written to one interval
+list and called in a single GATK run per ploidy value and sample.  With
+--chunk_size, long regions are split into padded windows that are called
+in parallel and stitched back into the region's VCF.  With --joint, all
+samples are passed to the same GATK run and a multi-sample VCF is written
+per region (or per ploidy) under args.outdir
+
+Every region VCF is checkpointed (see Checkpoint), so a rerun only calls
+GATK on the regions whose inputs changed or whose jobs failed
 """
 
 #Global
-import subprocess
+import os
+import threading
+import time
 
 #Repos
 from tools.formats.Bed import Bed
 from tools.io.Log import Log
 
 #Local
+from Checkpoint import Checkpoint
+from Metrics import Stage
+
+class GATKJob:
+    """A single UnifiedGenotyper run over regions of one or more BAM files
+    that share the same ploidy"""
+    def __init__(self, sampaths, regions, ploidy, outpath, interval_path=None, core=None):
+        """sampaths is a list of BAM paths, regions a list of
+        (chrom, start, end) and ploidy the GATK -ploidy value.  If
+        interval_path is given, GATK reads the regions from that interval
+        list instead of one -L argument per region.  core is the unpadded
+        (start, end) window of a chunk job; only variants inside it are
+        kept when chunks are stitched"""
+        self.sampaths = sampaths
+        self.regions = regions
+        self.ploidy = ploidy
+        self.outpath = outpath
+        self.interval_path = interval_path
+        self.core = core
+        self.runtime = None
+        self.code = None
+
+    def length(self):
+        """Returns the total number of bases covered by the job"""
+        return sum([end-start+1 for chrom, start, end in self.regions])
+
+    def name(self):
+        """Returns a short description of the job for logging"""
+        if self.interval_path != None:
+            reg_str = self.interval_path+" ("+str(len(self.regions))+" regions)"
+        else:
+            reg_str = ','.join([chrom+":"+str(start)+"-"+str(end) for chrom, start, end in self.regions])
+        return ','.join(self.sampaths)+" region "+reg_str+" with ploidy "+self.ploidy
+
+    def cmd(self, gatk, ref):
+        """Returns the GATK command line for this job"""
+        cmd = "java -jar "+gatk+" -T UnifiedGenotyper "
+        cmd += "-R "+ref
+        for sampath in self.sampaths:
+            cmd += " -I "+sampath
+        cmd += " -o "+self.outpath
+        cmd += " -glm BOTH"
+        if self.interval_path != None:
+            cmd += " -L "+self.interval_path
+        else:
+            for chrom, start, end in self.regions:
+                cmd += " -L "+chrom+":"+str(start)+"-"+str(end)
+        cmd += " -ploidy "+self.ploidy
+        return cmd
 
 class SegGATK:
     """Wrapper around GATK to call it incrementally on different
     regions of the same SAM file that have different ploidies"""
-    def __init__(self, sampath, args):
-        """Saves sampath and args (argparse object from
-        hpileup) and starts processing on each region"""
-        self.sampath = sampath
+    def __init__(self, sampaths, args):
+        """Saves sampaths (one BAM path or a list of them) and args (argparse
+        object from hpileup) and builds the jobs of each region.  They are
+        run one at a time with call_job (as tasks of a TaskGraph), followed
+        by finish"""
+        if isinstance(sampaths, str):
+            sampaths = [sampaths]
+        self.sampaths = sampaths
         self.args = args
         self.ploidy_bed = Bed(self.args.outdir+"ploidy.bed")
         self.l = Log()
+        self.jobs = []
+        self.failed = []
+        self.chunks = {}  #{region vcf path: [chunk GATKJob, ...] in region order}
+        self.regions = {}  #{chunk vcf path: region vcf path}
+        self.outputs = {}  #{output prefix: [vcf path, ...]} final VCFs of each call set
+        self.checkpoints = {}  #{region vcf path: Checkpoint}
+        self.skipped = set()  #region vcf paths whose checkpoints are still valid
+        self.stitched = set()  #chunked region vcf paths already stitched
+        self.pending = []  #jobs that were run (not up to date)
+        self.lock = threading.Lock()
 
-        self.iterate_gatk()
+        self.build_jobs()
 
     """
-    GATK iteration
+    Job building
     """
 
-    def iterate_gatk(self):
-        """Calls GATK successively on the input sam file,
-        using each region and ploidy from self.ploidy"""
-        gatk = self.args.gatk
-        ref = self.args.ref
-        self.l.log("SegGATK: Calling GATK on all ploidy regions for "+self.sampath+"...")
+    def call_sets(self):
+        """Returns [(sampaths, output prefix)] for the GATK runs of each region:
+        every sample on its own, or all samples together with args.joint"""
+        if self.args.joint:
+            return [(self.sampaths, self.args.outdir+"cohort")]
+        return [([sampath], '.'.join(sampath.split('.')[:-1])) for sampath in self.sampaths]
+
+    def output_prefix(self, sampath):
+        """Returns the key of self.outputs holding the VCFs that contain sampath"""
+        for sampaths, prefix in self.call_sets():
+            if sampath in sampaths:
+                return prefix
+
+    def build_jobs(self):
+        """Builds one GATKJob per call set and ploidy region (or per call set
+        and ploidy value with args.batch_ploidy), ordered longest region first
+        so the slowest jobs start earliest"""
+        if self.args.batch_ploidy:
+            if self.args.chunk_size > 0:
+                self.l.log("SegGATK: --chunk_size is not used with --batch_ploidy")
+            self.build_batch_jobs()
+        else:
+            self.build_region_jobs()
+        self.jobs = sorted(self.jobs, key=lambda job: job.length(), reverse=True)
+
+    def build_region_jobs(self):
+        """Builds one GATKJob per call set and ploidy region.  Regions longer
+        than args.chunk_size are split into chunk jobs"""
+        for sampaths, prefix in self.call_sets():
+            for line in self.ploidy_bed:
+                ploidy = str(2+int(line.data[0])*2)
+                reg_str = '-'.join([line.chromosome, str(line.start), str(line.end)])
+                outpath = prefix+"_"+reg_str+".vcf"
+                region = (line.chromosome, line.start, line.end)
+                self.outputs.setdefault(prefix, []).append(outpath)
+                if self.args.chunk_size > 0 and line.end-line.start+1 > self.args.chunk_size:
+                    self.build_chunk_jobs(sampaths, region, ploidy, outpath)
+                else:
+                    self.jobs.append(GATKJob(sampaths, [region], ploidy, outpath))
+
+    def build_chunk_jobs(self, sampaths, region, ploidy, outpath):
+        """Splits region into windows of args.chunk_size bases, each padded by
+        args.chunk_padding bases on both sides (within the region), and
+        builds one GATKJob per window.  Their VCFs are stitched into outpath"""
+        chrom, start, end = region
+        chunks = []
+        core_start = start
+        while core_start <= end:
+            core_end = min(end, core_start+self.args.chunk_size-1)
+            padded = (chrom, max(start, core_start-self.args.chunk_padding),
+                        min(end, core_end+self.args.chunk_padding))
+            chunk_path = outpath[:-len(".vcf")]+".chunk"+str(len(chunks)+1)+".vcf"
+            chunks.append(GATKJob(sampaths, [padded], ploidy, chunk_path, core=(core_start, core_end)))
+            self.regions[chunk_path] = outpath
+            core_start = core_end+1
+        self.chunks[outpath] = chunks
+        self.jobs += chunks
+
+    def build_batch_jobs(self):
+        """Groups the ploidy regions by ploidy, writes one GATK interval list
+        per ploidy to args.outdir and builds one GATKJob per call set and
+        ploidy value"""
+        groups = self.ploidy_groups()
+        for ploidy in sorted(groups.keys(), key=int):
+            interval_path = self.args.outdir+"ploidy_"+ploidy+".intervals"
+            outlines = [chrom+":"+str(start)+"-"+str(end)+'\n' for chrom, start, end in groups[ploidy]]
+            open(interval_path, 'w').writelines(outlines)
+            for sampaths, prefix in self.call_sets():
+                outpath = prefix+"_ploidy"+ploidy+".vcf"
+                self.outputs.setdefault(prefix, []).append(outpath)
+                self.jobs.append(GATKJob(sampaths, groups[ploidy], ploidy, outpath,
+                                            interval_path=interval_path))
+
+    def ploidy_groups(self):
+        """Returns {ploidy: [(chrom, start, end)]} for the regions in self.ploidy_bed"""
+        groups = {}
         for line in self.ploidy_bed:
             ploidy = str(2+int(line.data[0])*2)
-            reg_str = '-'.join([line.chromosome, str(line.start), str(line.end)])
-            outpath = '.'.join(self.sampath.split('.')[:-1])+"_"+reg_str+".vcf"
-            cmd = "java -jar "+gatk+" -T UnifiedGenotyper "
-            cmd += "-R "+ref+" -I "+self.sampath+" -o "+outpath
-            cmd += " -glm BOTH -L "
-            cmd += line.chromosome+":"+str(line.start)+"-"+str(line.end)
-            cmd += " -ploidy "+ploidy
-            self.l.log("Calling GATK on "+self.sampath+" region "+reg_str+" with ploidy "+ploidy)
-            self.l.log('\t'+cmd)
-            subprocess.call(cmd, shell=True)
+            groups.setdefault(ploidy, []).append((line.chromosome, line.start, line.end))
+        return groups
+
+    """
+    Checkpoints
+    """
+
+    def checkpoint(self, outpath, jobs):
+        """Returns the Checkpoint of the region VCF outpath written by jobs
+        (a single job, or the chunk jobs of the region)"""
+        sampaths = jobs[0].sampaths
+        inputs = sampaths+[sampath+".bai" for sampath in sampaths]+[self.args.ref, self.args.gatk]
+        if jobs[0].interval_path != None:
+            inputs.append(jobs[0].interval_path)
+        params = {"cmds": [job.cmd(self.args.gatk, self.args.ref) for job in jobs],
+                    "cores": [job.core for job in jobs]}
+        return Checkpoint(self.args, "gatk:"+outpath, inputs, [outpath], params=params)
+
+    def region_path(self, job):
+        """Returns the region VCF path that job writes (or is a chunk of)"""
+        return self.regions.get(job.outpath, job.outpath)
+
+    def is_current(self, job):
+        """Returns True if the region VCF written by job is up to date.  Each
+        region is checked once, when its first job is about to run"""
+        outpath = self.region_path(job)
+        with self.lock:
+            if outpath not in self.checkpoints:
+                self.checkpoints[outpath] = self.checkpoint(outpath, self.chunks.get(outpath, [job]))
+                if self.checkpoints[outpath].valid():
+                    self.skipped.add(outpath)
+            return outpath in self.skipped
+
+    """
+    GATK iteration
+    """
+
+    def call_job(self, job):
+        """Runs a single job unless its region VCF is up to date.  Returns
+        the job (its code is None if it was skipped).  Exits with an error
+        if GATK fails, so a TaskGraph marks the task failed and cancels the
+        tasks that depend on it"""
+        if self.is_current(job):
+            return job
+        with self.lock:
+            self.pending.append(job)
+        self.job_finished(self.run_job(job))
+        if job.code != 0:
+            self.l.error("SegGATK: GATK failed (exit code "+str(job.code)+") on "+job.name(),
+                            die=True, code=1)
+        return job
+
+    def job_finished(self, job):
+        """Reports the runtime and exit code of a job that has run, and
+        checkpoints its region VCF if it is not a chunk.  A chunked region
+        is stitched and checkpointed once all of its chunks have succeeded"""
+        if job.code != 0:
+            self.l.log("SegGATK: FAILED (exit code "+str(job.code)+") after "+
+                        "%.1f" % job.runtime+"s: "+job.name())
+            with self.lock:
+                self.failed.append(job)
+            return
+        self.l.log("SegGATK: Finished in "+"%.1f" % job.runtime+"s: "+job.name())
+        if job.outpath not in self.regions:
+            self.checkpoints[job.outpath].done()
+            return
+        outpath = self.regions[job.outpath]
+        with self.lock:
+            if outpath in self.stitched or len([chunk for chunk in self.chunks[outpath] if chunk.code != 0]) > 0:
+                return
+            self.stitched.add(outpath)
+        self.stitch_region(outpath)
+
+    def finish(self):
+        """Stitches the chunked regions and reports any failed jobs"""
+        self.stitch_chunks()
+        self.check_failures()
+
+    def check_failures(self):
+        """Exits with an error if any GATK job failed.  This is checked after
+        stitching, so the regions that did succeed are checkpointed"""
+        if len(self.failed) > 0:
+            self.l.error("SegGATK: "+str(len(self.failed))+" of "+str(len(self.pending))+
+                            " GATK jobs failed", die=True, code=1)
+
+    def run_job(self, job):
+        """Runs a single GATKJob, recording its exit code and runtime"""
+        cmd = job.cmd(self.args.gatk, self.args.ref)
+        self.l.log("Calling GATK on "+job.name())
+        self.l.log('\t'+cmd)
+        start = time.time()
+        with Stage(self.args, "gatk", sample=job.outpath) as stage:
+            job.code = stage.call(cmd)
+            stage.count("regions", len(job.regions))
+            stage.count("bases", job.length())
+        job.runtime = time.time()-start
+        return job
+
+    """
+    Chunk stitching
+    """
+
+    def stitch_chunks(self):
+        """Stitches every chunked region that has not been stitched yet.
+        Regions with a failed (or unrun) chunk are left unstitched"""
+        for outpath in self.chunks.keys():
+            with self.lock:
+                if (outpath in self.skipped or outpath in self.stitched or
+                        len([job for job in self.chunks[outpath] if job.code != 0]) > 0):
+                    continue
+                self.stitched.add(outpath)
+            self.stitch_region(outpath)
+
+    def stitch_region(self, outpath):
+        """Writes the VCF of the chunked region outpath from its chunk VCFs,
+        keeping each variant only from the chunk whose unpadded window
+        contains it so variants in the overlap padding are not duplicated,
+        then removes the chunk VCFs and checkpoints the region"""
+        chunks = self.chunks[outpath]
+        self.l.log("SegGATK: Stitching "+str(len(chunks))+" chunks into "+outpath+"...")
+        out = open(outpath, 'w')
+        for indx, job in enumerate(chunks):
+            core_start, core_end = job.core
+            for line in open(job.outpath):
+                if line[0] == "#":
+                    if indx == 0:
+                        out.write(line)  #header taken from the first chunk
+                    continue
+                pos = int(line.split('\t', 2)[1])
+                if pos >= core_start and pos <= core_end:
+                    out.write(line)
+        out.close()
+        for job in chunks:
+            for path in [job.outpath, job.outpath+".idx"]:
+                if os.path.exists(path):
+                    os.remove(path)
+        self.checkpoints[outpath].done()
 
 if __name__ == "__main__":
     print("SegGATK.py")
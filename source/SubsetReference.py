@@ -0,0 +1,130 @@
+"""
+This script defines a class to build a reduced reference that contains
+only the input and homologous regions (input_homolog.bed), index it for
+the read aligner once per run, and lift alignments against it back to genome
+coordinates.  Realigning sample reads against this reference is much
+cheaper than against the full genome index
+"""
+
+#Global
+
+#Repos
+from tools.formats.Bed import Bed
+from tools.io.Log import Log
+
+#Local
+from Alignment import backend
+from Checkpoint import Checkpoint
+from FastaSubset import FastaSubset
+from IntervalIndex import IntervalIndex
+from Metrics import Stage
+from Reference import Reference
+
+class SubsetReference:
+    """Builds or loads the homolog-only reference in args.outdir and
+    translates SAM lines aligned to it into genome coordinates"""
+    def __init__(self, args, build=False):
+        """Takes the argparse object from hpileup.  If build is True the
+        subset FASTA, its coordinate table and the index of the read aligner
+        (args.read_aligner) are generated first, otherwise the existing ones
+        are loaded"""
+        self.args = args
+        self.aligner = backend(args, args.read_aligner)
+        self.fasta_path = self.args.outdir+"input_homolog.fa"
+        self.lift_path = self.args.outdir+"input_homolog.lift"
+        self.index_path = self.args.outdir+"input_homolog"
+        self.lifts = {}  #{subset record name: (reference chrom, offset)}
+        self.chrom_lens = []  #[(reference chrom, length)] of every reference chromosome, in .fai order
+        self.l = Log()
+
+        if build:
+            self.build()
+        self.load_lift()
+        self.load_chroms()
+
+    """
+    Building the reduced reference
+    """
+
+    def build(self):
+        """Merges overlapping input_homolog.bed regions, so every genome
+        position is in at most one subset record and no read can lift to the
+        same locus twice, extracts them with FastaSubset and builds the read
+        aligner's index over them, unless the checkpoint of the last build
+        is still valid"""
+        ck = Checkpoint(self.args, "subset-reference", [self.args.outdir+"input_homolog.bed", self.args.ref],
+                        [self.fasta_path, self.lift_path, self.aligner.index_file(self.index_path)],
+                        params={"aligner": self.aligner.description(), "merged": True}, tools=[self.aligner.build_tool])
+        if ck.valid():
+            return
+        self.l.log("SubsetReference: Extracting input and homolog regions from "+self.args.ref+"...")
+        regions = IntervalIndex(Bed(self.args.outdir+"input_homolog.bed")).merged()
+        fs = FastaSubset(self.args.ref, regions)
+        fs.save(self.fasta_path)
+        fs.save_lift(self.lift_path)
+        self.build_index()
+        ck.done()
+
+    def build_index(self):
+        """Indexes the subset FASTA for the read aligner at self.index_path"""
+        cmd = self.aligner.build_cmd(self.fasta_path, self.index_path, self.args.threads)
+        self.l.log("SubsetReference: Building the "+self.aligner.name+" index with the following command...")
+        self.l.log("\t"+cmd)
+        with Stage(self.args, self.aligner.build_stage) as stage:
+            code = stage.call(cmd)
+        if code != 0:
+            self.l.error("SubsetReference: Indexing "+self.fasta_path+" for "+self.aligner.name+" failed",
+                            die=True, code=1)
+
+    def load_lift(self):
+        """Reads the coordinate table written by FastaSubset.save_lift"""
+        for line in open(self.lift_path):
+            name, chrom, start, end, chrom_len = line.strip('\n').split('\t')
+            self.lifts[name] = (chrom, int(start)-1)
+
+    def load_chroms(self):
+        """Reads the chromosomes of the full reference for the lifted header,
+        so lifted files have the same contigs in the same order as args.ref"""
+        reference = Reference(self.args.ref)
+        self.chrom_lens = [(chrom, str(reference.length(chrom))) for chrom in reference.chromosomes()]
+        reference.close()
+
+    """
+    Lifting alignments to genome coordinates
+    """
+
+    def lift_lines(self, lines):
+        """Generator that takes SAM lines aligned to the subset reference and
+        yields them in genome coordinates.  The subset @SQ header lines are
+        replaced by every chromosome of the reference, in .fai order"""
+        sq_written = False
+        for line in lines:
+            if line[0] == "@":
+                if line[:3] != "@SQ":
+                    yield line
+                elif not sq_written:
+                    for chrom, chrom_len in self.chrom_lens:
+                        yield "@SQ\tSN:"+chrom+"\tLN:"+chrom_len+"\n"
+                    sq_written = True
+                continue
+            yield self.lift_line(line)
+
+    def lift_line(self, line):
+        """Lifts RNAME/POS and RNEXT/PNEXT of a single SAM alignment line"""
+        linevals = line.split('\t', 9)
+        rname = linevals[2]
+        if rname in self.lifts:
+            chrom, offset = self.lifts[rname]
+            linevals[2] = chrom
+            if linevals[3] != "0":
+                linevals[3] = str(int(linevals[3])+offset)
+        rnext = rname if linevals[6] == "=" else linevals[6]
+        if rnext in self.lifts:
+            chrom, offset = self.lifts[rnext]
+            linevals[6] = "=" if chrom == linevals[2] else chrom
+            if linevals[7] != "0":
+                linevals[7] = str(int(linevals[7])+offset)
+        return '\t'.join(linevals)
+
+if __name__ == "__main__":
+    print("SubsetReference.py")
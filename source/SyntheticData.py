@@ -0,0 +1,202 @@
+"""
+This script generates synthetic inputs for benchmarking the pipeline
+without real data or an external aligner: a random reference genome with
+planted segmental duplications, a BED panel over the duplicated (and some
+unique) regions, the SAM file Bowtie 2 -k would write for the artificial
+reads of the panel, and a coordinate-sorted sample SAM/BAM file.  All
+sizes scale with a single factor and the output is reproducible from the
+seed
+"""
+
+#Global
+import os
+import pysam
+import random
+
+#Repos
+from tools.io.Log import Log
+
+#Local
+
+BASES = "ACGT"
+LINE_WIDTH = 60  #bases per FASTA line
+
+class SyntheticData:
+    """Builds and saves a synthetic data set in outdir.  Coordinates of the
+    planted duplications are kept in self.dups as
+    (source chrom, source start, copy chrom, copy start, length), 0-based"""
+    def __init__(self, outdir, scale=1, chroms=2, chrom_len=200000, dups_per_chrom=4, dup_len=5000,
+                    divergence=0.01, sample_reads=20000, read_len=150, seed=1):
+        """Sizes are given for scale 1; chromosome length, duplications and
+        sample reads grow linearly with scale"""
+        self.outdir = outdir if outdir[-1] == "/" else outdir+"/"
+        self.chrom_names = ["chr"+str(indx+1) for indx in range(chroms)]
+        self.chrom_len = int(chrom_len*scale)
+        self.dup_count = max(1, int(dups_per_chrom*scale))*chroms
+        self.dup_len = dup_len
+        self.divergence = divergence
+        self.sample_reads = int(sample_reads*scale)
+        self.read_len = read_len
+        self.rand = random.Random(seed)
+        self.l = Log()
+        self.seqs = {}  #{chrom: sequence}
+        self.dups = []
+        self.panel = []  #[(chrom, start, end)] 1-based, inclusive, as in the pipeline's bed files
+
+        self.ref_path = self.outdir+"reference.fa"
+        self.panel_path = self.outdir+"panel.bed"
+        self.tiles_path = self.outdir+"artificial_aligned.sam"
+        self.sample_path = self.outdir+"sample.sam"
+        self.bam_path = self.outdir+"sample.bam"
+
+    """
+    Reference and panel
+    """
+
+    def build_reference(self):
+        """Draws random chromosomes and copies dup_len segments between free
+        slots, mutating each copied base with probability divergence"""
+        for chrom in self.chrom_names:
+            self.seqs[chrom] = [self.rand.choice(BASES) for indx in range(self.chrom_len)]
+        slot_len = self.dup_len*2
+        slots = [(chrom, start) for chrom in self.chrom_names
+                    for start in range(0, self.chrom_len-slot_len+1, slot_len)]
+        self.rand.shuffle(slots)
+        if len(slots) < self.dup_count*2:
+            self.l.error("SyntheticData: Chromosomes of "+str(self.chrom_len)+"bp are too short for "+
+                            str(self.dup_count)+" duplications of "+str(self.dup_len)+"bp", die=True, code=1)
+        for indx in range(self.dup_count):
+            (src_chrom, src_start), (dst_chrom, dst_start) = slots[2*indx], slots[2*indx+1]
+            for offset in range(self.dup_len):
+                base = self.seqs[src_chrom][src_start+offset]
+                if self.rand.random() < self.divergence:
+                    base = self.rand.choice(BASES.replace(base, ""))
+                self.seqs[dst_chrom][dst_start+offset] = base
+            self.dups.append((src_chrom, src_start, dst_chrom, dst_start, self.dup_len))
+        for chrom in self.chrom_names:
+            self.seqs[chrom] = ''.join(self.seqs[chrom])
+        ##the panel holds the source copy of every duplication and as many unique regions
+        self.panel = [(chrom, start+1, start+length) for chrom, start, dst_chrom, dst_start, length in self.dups]
+        for chrom, start in slots[2*self.dup_count:3*self.dup_count]:
+            self.panel.append((chrom, start+1, start+self.dup_len))
+        self.panel = sorted(self.panel, key=lambda region: (region[0], region[1]))
+
+    def save_reference(self):
+        """Writes the reference FASTA and the panel BED"""
+        out = open(self.ref_path, 'w')
+        for chrom in self.chrom_names:
+            seq = self.seqs[chrom]
+            out.write(">"+chrom+"\n")
+            for indx in range(0, len(seq), LINE_WIDTH):
+                out.write(seq[indx:indx+LINE_WIDTH]+"\n")
+        out.close()
+        outlines = [chrom+'\t'+str(start)+'\t'+str(end)+'\n' for chrom, start, end in self.panel]
+        open(self.panel_path, 'w').writelines(outlines)
+
+    def header(self, extra=None):
+        """Returns the SAM header lines for the reference"""
+        lines = ["@HD\tVN:1.6\tSO:"+("coordinate" if extra != None else "unsorted")+"\n"]
+        lines += ["@SQ\tSN:"+chrom+"\tLN:"+str(len(self.seqs[chrom]))+"\n" for chrom in self.chrom_names]
+        if extra != None:
+            lines += extra
+        return lines
+
+    """
+    Artificial read alignments
+    """
+
+    def copies(self, chrom, start, end):
+        """Returns the 0-based starts of the other copies of [start, end)
+        on chrom, as [(chrom, start)]"""
+        out = []
+        for src_chrom, src_start, dst_chrom, dst_start, length in self.dups:
+            if src_chrom == chrom and start >= src_start and end <= src_start+length:
+                out.append((dst_chrom, dst_start+start-src_start))
+        return out
+
+    def save_tiles(self, readlen=1000, overlap=0.75):
+        """Writes the SAM file of the artificial reads of the panel (tiled
+        as FakeFastq does) aligned with Bowtie 2 -k: one primary alignment
+        at the read's origin and a secondary one on every duplicated copy.
+        Returns the number of alignments"""
+        out = open(self.tiles_path, 'w')
+        out.writelines(self.header())
+        step = readlen-int(readlen*overlap)
+        cigar = str(readlen)+"M"
+        count = 0
+        for region, (chrom, start, end) in enumerate(self.panel):
+            rid = 1
+            for read_start in range(start-1, end-readlen+1, step):
+                qname = "g"+str(region+1)+"_r"+str(rid)
+                seq = self.seqs[chrom][read_start:read_start+readlen]
+                out.write('\t'.join([qname, "0", chrom, str(read_start+1), "1", cigar, "*", "0", "0",
+                                        seq, "~"*readlen])+'\n')
+                for copy_chrom, copy_start in self.copies(chrom, read_start, read_start+readlen):
+                    out.write('\t'.join([qname, "256", copy_chrom, str(copy_start+1), "1", cigar, "*", "0",
+                                            "0", "*", "*"])+'\n')
+                    count += 1
+                count += 1
+                rid += 1
+        out.close()
+        return count
+
+    """
+    Sample reads
+    """
+
+    def save_sample(self):
+        """Writes a coordinate-sorted sample SAM file with read groups.  Half
+        of the reads fall in duplicated regions, the rest anywhere.  Returns
+        the number of reads"""
+        reads = []
+        for indx in range(self.sample_reads):
+            if indx%2 == 0:
+                src_chrom, src_start, dst_chrom, dst_start, length = self.rand.choice(self.dups)
+                chrom, start = self.rand.choice([(src_chrom, src_start), (dst_chrom, dst_start)])
+                pos = start+self.rand.randint(0, length-self.read_len)
+            else:
+                chrom = self.rand.choice(self.chrom_names)
+                pos = self.rand.randint(0, self.chrom_len-self.read_len)
+            reads.append((self.chrom_names.index(chrom), pos, chrom))
+        reads.sort()
+        out = open(self.sample_path, 'w')
+        out.writelines(self.header(["@RG\tID:old\tSM:old\n"]))
+        qual = "I"*self.read_len
+        cigar = str(self.read_len)+"M"
+        for indx, (chrom_id, pos, chrom) in enumerate(reads):
+            flag = self.rand.choice(["0", "16", "256", "272"])
+            seq = self.seqs[chrom][pos:pos+self.read_len]
+            out.write('\t'.join(["read"+str(indx), flag, chrom, str(pos+1), str(self.rand.randint(0, 42)),
+                                    cigar, "*", "0", "0", seq, qual, "NM:i:0", "RG:Z:old"])+'\n')
+        out.close()
+        return len(reads)
+
+    def save_bam(self):
+        """Converts the sample SAM to an indexed BAM with pysam"""
+        insam = pysam.AlignmentFile(self.sample_path, 'r')
+        outbam = pysam.AlignmentFile(self.bam_path, 'wb', template=insam)
+        for rec in insam:
+            outbam.write(rec)
+        outbam.close()
+        insam.close()
+        pysam.index(self.bam_path)
+
+    """
+    Driver
+    """
+
+    def build(self, bam=True):
+        """Generates and saves the whole data set"""
+        if not os.path.exists(self.outdir):
+            os.makedirs(self.outdir)
+        self.l.log("SyntheticData: Building a "+str(len(self.chrom_names))+"x"+str(self.chrom_len)+
+                    "bp reference with "+str(self.dup_count)+" duplications in "+self.outdir+"...")
+        self.build_reference()
+        self.save_reference()
+        self.save_tiles()
+        self.save_sample()
+        if bam:
+            self.save_bam()
+
+if __name__ == "__main__":
+    print("SyntheticData.py")
@@ -0,0 +1,191 @@
+"""
+This script defines a dependency graph of pipeline tasks and a scheduler
+that starts every task as soon as the tasks it depends on have finished
+and enough CPU and memory slots are free.  Per-sample stages that run
+Python code over whole files go to worker processes; tasks that mostly
+wait on an external tool (GATK) run in threads.  Tasks of later stages
+are started first, so each sample moves through the pipeline as early as
+possible instead of waiting for every other sample to finish a stage.
+A task that has waited longest for slots reserves them, so a stream of
+small high priority tasks cannot keep a large one from ever starting
+"""
+
+#Global
+import concurrent.futures
+import copy
+import time
+
+#Repos
+from tools.io.Log import Log
+
+#Local
+from SampleScheduler import run_logged
+
+class Task:
+    """A unit of work in a TaskGraph: fn(*fn_args) plus the tasks it
+    depends on and the CPU slots and memory (GB) it needs"""
+    def __init__(self, name, fn, fn_args, deps=None, cpus=1, memory=0, priority=0,
+                    process=False, logpath=None, min_cpus=None):
+        """If process is True, fn must be a module level function taking
+        (args, sample_path), as pileup_sample and variant_calling_sample do, and it
+        runs in a worker process with its output sent to logpath.  The task
+        starts with up to cpus slots once at least min_cpus (default cpus)
+        are free, and a process task gets a copy of args with threads set to
+        the slots it was granted.  Among the ready tasks, those with a higher
+        priority are started first"""
+        self.name = name
+        self.fn = fn
+        self.fn_args = fn_args
+        self.deps = deps if deps != None else []
+        self.cpus = cpus
+        self.min_cpus = min_cpus if min_cpus != None else cpus
+        self.memory = memory
+        self.priority = priority
+        self.process = process
+        self.logpath = logpath
+        self.state = "waiting"  #waiting, running, done, failed or cancelled
+        self.start = None
+        self.granted = 0  #CPU slots the task runs with
+        self.ready_seq = None  #order in which the task became ready
+
+class TaskGraph:
+    """Runs a set of Tasks in dependency order within a budget of CPU slots
+    and, optionally, memory"""
+    def __init__(self, cpus, memory=None):
+        """cpus is the number of CPU slots (args.threads) and memory the
+        memory budget in GB, or None to not limit memory"""
+        self.cpus = max(1, cpus)
+        self.memory = memory
+        self.tasks = []
+        self.ready_count = 0  #tasks that have become ready so far
+        self.reserved = None  #task the free slots are held for
+        self.l = Log()
+
+    def add(self, task):
+        """Adds task to the graph and returns it"""
+        self.tasks.append(task)
+        return task
+
+    """
+    Scheduling
+    """
+
+    def ready(self):
+        """Returns the waiting tasks whose dependencies are all done, highest
+        priority first (then in the order they were added), numbering them
+        in the order they became ready"""
+        ready = [task for task in self.tasks
+                    if task.state == "waiting" and all([dep.state == "done" for dep in task.deps])]
+        for task in ready:
+            if task.ready_seq == None:
+                task.ready_seq = self.ready_count
+                self.ready_count += 1
+        return sorted(ready, key=lambda task: -task.priority)
+
+    def cancel_blocked(self):
+        """Cancels the waiting tasks that depend on a failed or cancelled task"""
+        cancelled = True
+        while cancelled:
+            cancelled = False
+            for task in self.tasks:
+                if task.state == "waiting" and any([dep.state in ("failed", "cancelled") for dep in task.deps]):
+                    self.l.log("TaskGraph: Cancelling "+task.name+", a task it depends on failed")
+                    task.state = "cancelled"
+                    cancelled = True
+
+    def slots(self, task):
+        """Returns the (cpus, memory) task takes from the budget.  A task asking
+        for more than the whole budget gets all of it and runs alone"""
+        memory = task.memory if self.memory == None else min(task.memory, self.memory)
+        return min(task.cpus, self.cpus), memory
+
+    def grant(self, task, cpus_free, memory_free):
+        """Returns the CPU slots task starts with out of cpus_free, or 0 if
+        fewer than its min_cpus are free or it needs more than memory_free"""
+        cpus, memory = self.slots(task)
+        if cpus_free < min(task.min_cpus, cpus) or (self.memory != None and memory > memory_free):
+            return 0
+        return min(cpus, cpus_free)
+
+    def reserve(self, task):
+        """Holds the free slots for task if it has been ready longer than the
+        task currently holding them.  Until it starts, other tasks may only
+        use the slots it does not need"""
+        if self.reserved == None or task.ready_seq < self.reserved.ready_seq:
+            self.reserved = task
+
+    def task_args(self, task):
+        """Returns the arguments task is called with: for a process task, a
+        copy of args with threads set to the slots it was granted"""
+        if not task.process:
+            return task.fn_args
+        args = copy.copy(task.fn_args[0])
+        args.threads = task.granted
+        return (args,)+tuple(task.fn_args[1:])
+
+    def run(self):
+        """Runs every task, dying with an error at the end if any failed.
+        With a single CPU slot, process tasks run one at a time in a thread of
+        this process, still logging to their logpath"""
+        procs = concurrent.futures.ProcessPoolExecutor(max_workers=self.cpus)
+        threads = concurrent.futures.ThreadPoolExecutor(max_workers=self.cpus)
+        running = {}  #{future: task}
+        cpus_used, memory_used = 0, 0
+        self.l.log("TaskGraph: Running "+str(len(self.tasks))+" tasks with "+str(self.cpus)+" CPU slots"+
+                    ("" if self.memory == None else " and "+str(self.memory)+"GB of memory")+"...")
+        try:
+            while True:
+                self.cancel_blocked()
+                if self.reserved != None and self.reserved.state != "waiting":
+                    self.reserved = None
+                for task in self.ready():
+                    cpus_free = self.cpus-cpus_used
+                    memory_free = None if self.memory == None else self.memory-memory_used
+                    if self.reserved != None and task is not self.reserved:
+                        cpus, memory = self.slots(self.reserved)
+                        cpus_free -= min(self.reserved.min_cpus, cpus)
+                        memory_free = None if self.memory == None else memory_free-memory
+                    task.granted = self.grant(task, cpus_free, memory_free)
+                    if task.granted == 0:
+                        self.reserve(task)
+                        continue
+                    if task is self.reserved:
+                        self.reserved = None
+                    cpus_used += task.granted
+                    memory_used += self.slots(task)[1]
+                    task.state = "running"
+                    task.start = time.time()
+                    fn_args = self.task_args(task)
+                    if task.process and self.cpus > 1:
+                        future = procs.submit(run_logged, task.fn, fn_args[0], fn_args[1], task.logpath)
+                    elif task.process and task.logpath != None:
+                        future = threads.submit(run_logged, task.fn, fn_args[0], fn_args[1], task.logpath)
+                    else:
+                        future = threads.submit(task.fn, *fn_args)
+                    running[future] = task
+                if len(running) == 0:
+                    break
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    cpus_used -= task.granted
+                    memory_used -= self.slots(task)[1]
+                    runtime = "%.1f" % (time.time()-task.start)+"s"
+                    try:
+                        future.result()
+                        task.state = "done"
+                        self.l.log("TaskGraph: Finished "+task.name+" in "+runtime)
+                    except BaseException as e:
+                        task.state = "failed"
+                        self.l.log("TaskGraph: "+task.name+" failed after "+runtime+" ("+repr(e)+")"+
+                                    ("" if task.logpath == None else ", see "+task.logpath))
+        finally:
+            procs.shutdown()
+            threads.shutdown()
+        failed = [task for task in self.tasks if task.state != "done"]
+        if len(failed) > 0:
+            self.l.error("TaskGraph: "+str(len(failed))+" of "+str(len(self.tasks))+
+                            " tasks failed or were cancelled", die=True, code=1)
+
+if __name__ == "__main__":
+    print("TaskGraph.py")
@@ -4,6 +4,8 @@ For reference, see variant_calling.ipynb
 """
 
 #Global
+import heapq
+import pysam
 import subprocess
 
 #Repos
@@ -11,131 +13,207 @@ import tools.io.file_iterator as fi
 from tools.io.Log import Log
 
 #Local
+from Checkpoint import Checkpoint
+from Metrics import Stage
 from SegGATK import SegGATK
 
+ID_KEYS = set(["##INFO", "##FORMAT", "##FILTER", "##ALT", "##contig"])  #header lines merged by ID
+
+def variant_calling_sample(args, sample_path):
+    """Runs the variant calling steps for a single sample (TaskGraph entry
+    point)"""
+    VariantCalling(args).process_sample(sample_path)
+
 class VariantCalling:
     """This class implements the variant calling stage of the
     pipeline"""
     def __init__(self, args):
-        """Saves args (argparse object from hpileup) and executes
-        the variant calling pipeline steps"""
+        """Saves args (argparse object from hpileup).  The variant calling
+        steps are run per sample by process_sample and per call set by
+        finish_call_set"""
         self.args = args
         self.l = Log()
+        self.reads = 0  #reads written by reset_mapq
 
-        self.run()
-        
     """
     Pipeline driver
     """
 
-    def run(self):
-        """Pipeline driver function"""
-        self.l.log("VariantCalling: Calling variants for all samples...")
-        for sample_path in self.args.samples:
+    def finish_call_set(self, segs, sample_paths):
+        """Finishes a SegGATK whose jobs have all run through call_job,
+        then merges its VCFs (TaskGraph entry point)"""
+        segs.finish()
+        self.merge_call_set(segs, sample_paths)
+
+    def merge_call_set(self, segs, sample_paths):
+        """Merges the per-region VCFs written by segs for sample_paths into
+        one VCF per sample, or into the cohort VCF with args.joint"""
+        if self.args.joint:
+            prefix = segs.output_prefix(self.sorted_bam(sample_paths[0]))
+            self.merge_vcf(prefix, segs.outputs.get(prefix, []))
+            return
+        for sample_path in sample_paths:
             outbase = ".".join(sample_path.split('.')[:-1])
-            self.l.log("VariantCalling: Calling variants for "+outbase+"...")
-
-            ##set all mapping qualities to 60
-            self.reset_mapq(outbase)
-
-            ##convert sam to bam
-            self.sam2bam(outbase)
-
-            ##add read groups
-            self.add_read_groups(outbase)
-            
-            ##sort + index
-            self.sort_index(outbase)
-
-            ##call incremental GATK
-            SegGATK(outbase+"_reset-mapq_rg_sorted.bam", self.args)
+            prefix = segs.output_prefix(self.sorted_bam(sample_path))
+            self.merge_vcf(outbase, segs.outputs.get(prefix, []))
+
+    def process_sample(self, sample_path):
+        """Prepares the sorted, indexed BAM of a single sample for GATK,
+        unless its checkpoint is still valid"""
+        outbase = ".".join(sample_path.split('.')[:-1])
+        output_bam = self.sorted_bam(sample_path)
+        ck = Checkpoint(self.args, "sorted-bam:"+sample_path, [outbase+"_realigned_input.sam"],
+                        [output_bam, output_bam+".bai"],
+                        params={"sample_name": self.sample_name(sample_path), "rg_platform": self.args.rg_platform},
+                        tools=[self.args.samtools_loc])
+        if ck.valid():
+            return
+        self.l.log("VariantCalling: Preparing "+outbase+" for variant calling...")
+
+        ##reset mapping qualities, add read groups, sort and index in one pass
+        self.write_sorted_bam(outbase, self.sample_name(sample_path))
+        ck.done()
+
+    def sorted_bam(self, sample_path):
+        """Returns the path of the BAM written by process_sample for sample_path"""
+        return ".".join(sample_path.split('.')[:-1])+"_reset-mapq_rg_sorted.bam"
+
+    def sample_name(self, sample_path):
+        """Returns the read group sample name for sample_path, taken from
+        args.sample_names if given, otherwise from the file name"""
+        if self.args.sample_names != None:
+            return self.args.sample_names[self.args.samples.index(sample_path)]
+        return ".".join(sample_path.split('/')[-1].split('.')[:-1])
 
     """
     Reset mapping quality
     """
     
-    def reset_mapq(self, outbase):
-        """Takes the location of an input SAM file
-        and iterates through it, setting all mapping quality
-        scores to 60"""
-        outlines = []
-        self.l.log("VariantCalling: Setting mapping qualities for "+outbase+" to 60...")
-        for line in fi.iterate(open(outbase+'_realigned_input.sam')):
+    def reset_mapq(self, lines, sample_name):
+        """Generator that takes the lines of a SAM file and yields them with
+        all mapping quality scores set to 60, secondary flags (256/272)
+        cleared and every read assigned to a read group for sample_name.
+        Any existing read groups are replaced"""
+        rg_line = "@RG\tID:"+sample_name+"\tLB:lib1\tPL:"+self.args.rg_platform
+        rg_line += "\tPU:unit1\tSM:"+sample_name+"\n"
+        rg_tag = "RG:Z:"+sample_name
+        rg_written = False
+        for line in lines:
             if line[0] == "@":
-                outlines.append(line)
+                if line[:3] != "@RG":
+                    yield line
                 continue
+            if not rg_written:
+                yield rg_line
+                rg_written = True
             linevals = line.strip('\n').split('\t')
             linevals[4] = "60"
             if linevals[1] == "256":
                 linevals[1] = "0"
             elif linevals[1] == "272":
                 linevals[1] = "16"
-            outlines.append('\t'.join(linevals)+'\n')
-        open(outbase+"_reset-mapq.sam", 'w').writelines(outlines)
-
-    """
-    SAM to BAM
-    """
-
-    def sam2bam(self, outbase):
-        """Converts the input sam filed to compressed bam format"""
-        input_sam = outbase+"_reset-mapq.sam"
-        output_bam = outbase+"_reset-mapq.bam"
-        samtools = self.args.samtools_loc
-        cmd = samtools+" view -S -b "+input_sam+" > "+output_bam
-        self.l.log("VariantCalling: Converting "+outbase+" to compressed BAM format...")
-        self.l.log("\t"+cmd)
-        subprocess.call(cmd, shell=True)
+            linevals = linevals[:11]+[val for val in linevals[11:] if val[:5] != "RG:Z:"]
+            linevals.append(rg_tag)
+            self.reads += 1
+            yield '\t'.join(linevals)+'\n'
+        if not rg_written:
+            yield rg_line
 
     """
-    Picard Read Groups
+    Sorted BAM writing
     """
 
-    def add_read_groups(self, outbase):
-        """Calls the Picard jar to add read groups to the
-        input SAM (necessary for sorting/indexing"""
-        input_bam = outbase+"_reset-mapq.bam"
-        output_bam = outbase+"_reset-mapq_rg.bam"
-        picard = self.args.picard
-        cmd = "java -jar "+picard+" AddOrReplaceReadGroups "
-        cmd += "I="+input_bam
-        cmd += " O="+output_bam
-        cmd += " RGID=4 RGLB=lib1 RGPL=illumina RGPU=unit1 RGSM=20 "
-        cmd += "VALIDATION_STRINGENCY=LENIENT"
-        self.l.log("VariantCalling: Adding read groups with the following command...")
-        self.l.log("\t"+cmd)
-        subprocess.call(cmd, shell=True)
-
-    """
-    Sort/index bam
-    """
-
-    def sort_index(self, outbase):
-        """Calls samtools sort and samtools index on the input bam"""
-        input_bam = outbase+"_reset-mapq_rg.bam"
+    def write_sorted_bam(self, outbase, sample_name):
+        """Streams the realigned input SAM through reset_mapq into samtools
+        sort, writing a sorted BAM with read groups directly, then indexes it.
+        No intermediate SAM/BAM files are written"""
+        input_sam = outbase+"_realigned_input.sam"
         output_bam = outbase+"_reset-mapq_rg_sorted.bam"
         samtools = self.args.samtools_loc
 
-        cmd = samtools+" sort "+input_bam+" -o "+output_bam
-        self.l.log("VariantCalling: Sorting bam with the following command...")
+        cmd = samtools+" sort -@ "+str(max(0, self.args.threads-1))+" -o "+output_bam+" -"  #-@ counts extra threads
+        self.l.log("VariantCalling: Setting mapping qualities for "+outbase+" to 60, adding read group "+
+                    sample_name+" and sorting with the following command...")
         self.l.log("\t"+cmd)
-        subprocess.call(cmd, shell=True)
-
-        input_bam = output_bam
-        cmd = samtools+" index "+input_bam
+        with Stage(self.args, "samtools-sort", sample=input_sam) as stage:
+            self.reads = 0
+            proc = stage.popen(cmd, stdin=subprocess.PIPE, universal_newlines=True)
+            proc.stdin.writelines(self.reset_mapq(fi.iterate(open(input_sam)), sample_name))
+            proc.stdin.close()
+            code = stage.wait(proc)
+            stage.count("reads", self.reads)
+        if code != 0:
+            self.l.error("VariantCalling: samtools sort failed for "+input_sam, die=True, code=1)
+
+        cmd = samtools+" index "+output_bam
         self.l.log("VariantCalling: Indexing bam with the following command...")
         self.l.log("\t"+cmd)
-        subprocess.call(cmd, shell=True)
+        with Stage(self.args, "samtools-index", sample=output_bam) as stage:
+            stage.call(cmd)
 
     """
     VCF Merging
     """
 
-    def merge_vcf(self, outbase):
+    def merge_vcf(self, outbase, vcf_paths):
         """Following multi-ploidy calls from SegGATK, merge
         all VCFs into a single output VCF with variants from
-        regions with multiple ploidies (depends on implementation
-        of SegGATK)"""
+        regions with multiple ploidies.  vcf_paths are the per-region
+        VCFs of the sample, each sorted internally; they are k-way merged
+        line by line into outbase.vcf.gz (bgzipped, tabix indexed)"""
+        if len(vcf_paths) == 0:
+            self.l.log("VariantCalling: No VCFs to merge for "+outbase)
+            return
+        outpath = outbase+".vcf.gz"
+        self.l.log("VariantCalling: Merging "+str(len(vcf_paths))+" VCFs into "+outpath+"...")
+        header, contigs = self.merge_vcf_headers(vcf_paths)
+
+        def sort_key(line):
+            chrom, pos = line.split('\t', 2)[:2]
+            return (contigs.get(chrom, len(contigs)), chrom, int(pos))
+
+        with Stage(self.args, "merge-vcf", sample=outbase) as stage:
+            vcfs = [open(vcf_path) for vcf_path in vcf_paths]
+            bodies = [(line for line in vcf if line[0] != "#") for vcf in vcfs]
+            out = pysam.BGZFile(outpath, 'wb')
+            out.write(''.join(header).encode())
+            for line in heapq.merge(*bodies, key=sort_key):
+                out.write(line.encode())
+                stage.count("variants")
+            out.close()
+            for vcf in vcfs:
+                vcf.close()
+            pysam.tabix_index(outpath, preset="vcf", force=True)
+
+    def merge_vcf_headers(self, vcf_paths):
+        """Reads only the headers of vcf_paths and returns the merged header
+        lines and {contig: rank} for sorting.  INFO, FORMAT, FILTER, ALT and
+        contig lines are kept once per ID, other meta lines once per distinct
+        text, so the GATK command line of each ploidy is retained"""
+        meta, seen, contigs = [], set(), {}
+        chrom_line = None
+        for vcf_path in vcf_paths:
+            for line in open(vcf_path):
+                if line[:2] != "##":
+                    if line[0] == "#":
+                        if chrom_line == None:
+                            chrom_line = line
+                        elif line != chrom_line:
+                            self.l.error("VariantCalling: Sample columns of "+vcf_path+
+                                            " do not match the other VCFs", die=True, code=1)
+                    break
+                key = line
+                if line.split('=<ID=')[0] in ID_KEYS:
+                    key = line.split(',')[0].split('>')[0]  #up to ##KEY=<ID=value
+                if key in seen:
+                    continue
+                seen.add(key)
+                meta.append(line)
+                if line[:13] == "##contig=<ID=":
+                    contigs[key[13:]] = len(contigs)
+        if chrom_line == None:
+            chrom_line = "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+        return meta+[chrom_line], contigs
 
 
 if __name__ == "__main__":
@@ -0,0 +1,196 @@
+"""
+This file defines a benchmark harness for the Python hot paths of the
+hpileup pipeline.  Synthetic data sets (see SyntheticData) are generated
+at increasing scales, and FakeFastq, QnameMaps, MergedMaps,
+SamRegionFilter (SAM scan and indexed BAM fetch) and
+VariantCalling.reset_mapq are timed on each.  Every measurement runs in a
+fresh worker process so its peak memory can be reported, and throughput
+and scaling curves are written to benchmark_report.json in --outdir.
+No aligner or other external tool is needed
+"""
+
+#Global
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+import resource
+import time
+import types
+
+#Repos
+import tools.formats.Bed as Bed
+from tools.io.Log import Log
+
+#Local
+from FakeFastq import FakeFastq
+from HomologMapping import MergedMaps, QnameMaps
+from SamRegionFilter import SamRegionFilter as SRF
+from SyntheticData import SyntheticData
+from VariantCalling import VariantCalling
+
+##Benchmarks: each takes the paths of a synthetic data set (see DATA_PATHS),
+##does any setup untimed and returns (items processed, seconds) of the timed part
+
+def bench_fakefastq(data):
+    """Tiles the panel into artificial reads and writes them"""
+    start = time.perf_counter()
+    ffq = FakeFastq(Bed.Bed(data.panel_path), data.ref_path)
+    ffq.save(data.outdir+"bench_reads.fq")
+    ffq.close()
+    return ffq.reads, time.perf_counter()-start
+
+def bench_qnamemaps(data):
+    """Parses the artificial read alignments"""
+    start = time.perf_counter()
+    qm = QnameMaps(data.tiles_path, data.panel_path)
+    return len(qm), time.perf_counter()-start
+
+def bench_mergedmaps(data):
+    """Merges and filters the HomMaps of the artificial reads"""
+    qm = QnameMaps(data.tiles_path, data.panel_path)
+    start = time.perf_counter()
+    MergedMaps(qm, filt_len=1000)
+    return len(qm), time.perf_counter()-start
+
+def bench_srf_sam(data):
+    """Filters the sample SAM to the panel regions by scanning it"""
+    start = time.perf_counter()
+    srf = SRF(data.sample_path, data.panel_path, outpath=data.outdir+"bench_filtered.sam")
+    return srf.reads_seen, time.perf_counter()-start
+
+def bench_srf_bam(data):
+    """Filters the indexed sample BAM to the panel regions"""
+    start = time.perf_counter()
+    srf = SRF(data.bam_path, data.panel_path, outpath=data.outdir+"bench_filtered_bam.sam")
+    return srf.reads_seen, time.perf_counter()-start
+
+def bench_reset_mapq(data):
+    """Resets mapping qualities and read groups of the sample SAM"""
+    vc = VariantCalling(types.SimpleNamespace(rg_platform="illumina"))
+    start = time.perf_counter()
+    for line in vc.reset_mapq(open(data.sample_path), "bench"):
+        pass
+    return vc.reads, time.perf_counter()-start
+
+def bench_baseline(data):
+    """Does nothing, to measure the memory of an idle worker"""
+    return 0, 0.0
+
+DATA_PATHS = ["outdir", "ref_path", "panel_path", "tiles_path", "sample_path", "bam_path"]
+
+BENCHMARKS = {"fakefastq": bench_fakefastq, "qnamemaps": bench_qnamemaps, "mergedmaps": bench_mergedmaps,
+                "srf_sam": bench_srf_sam, "srf_bam": bench_srf_bam, "reset_mapq": bench_reset_mapq}
+
+def measure(name, data):
+    """Runs benchmark name in this process and returns
+    (items, seconds, peak RSS in KB)"""
+    if name == "baseline":
+        items, seconds = bench_baseline(data)
+    else:
+        items, seconds = BENCHMARKS[name](data)
+    return items, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def slope(xs, ys):
+    """Returns the least squares slope of log(ys) against log(xs), or None
+    if there are fewer than two positive points"""
+    points = [(math.log(x), math.log(y)) for x, y in zip(xs, ys) if x > 0 and y > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum([x for x, y in points])/len(points)
+    mean_y = sum([y for x, y in points])/len(points)
+    var = sum([(x-mean_x)**2 for x, y in points])
+    if var == 0:
+        return None
+    return round(sum([(x-mean_x)*(y-mean_y) for x, y in points])/var, 3)
+
+class Benchmark:
+    """Generates a synthetic data set per scale, runs the benchmarks on it
+    and saves the report"""
+    def __init__(self, args):
+        """Takes the argparse object from main and runs every benchmark"""
+        self.args = args
+        self.l = Log()
+        self.names = self.args.only if self.args.only != None else list(BENCHMARKS.keys())
+        self.results = dict([(name, []) for name in self.names])  #{benchmark: [result per scale]}
+
+        for scale in self.args.scales:
+            self.run_scale(scale)
+        self.save()
+
+    """
+    Running
+    """
+
+    def run_once(self, name, data):
+        """Runs one benchmark in a fresh worker process"""
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            return pool.submit(measure, name, data).result()
+
+    def run_scale(self, scale):
+        """Builds the data set for scale and runs the selected benchmarks on
+        it args.repeat times, keeping the fastest time and largest memory"""
+        synthetic = SyntheticData(self.args.outdir+"scale_"+str(scale)+"/", scale=scale, seed=self.args.seed)
+        synthetic.build(bam="srf_bam" in self.names)
+        ##only the paths are sent to the workers, not the generated sequences
+        data = types.SimpleNamespace(**dict([(key, getattr(synthetic, key)) for key in DATA_PATHS]))
+        del synthetic
+        baseline = self.run_once("baseline", data)[2]
+        for name in self.names:
+            runs = [self.run_once(name, data) for indx in range(self.args.repeat)]
+            items = runs[0][0]
+            seconds = min([run[1] for run in runs])
+            peak = max([run[2] for run in runs])
+            result = {"scale": scale, "items": items, "seconds": round(seconds, 4),
+                        "items_per_s": round(items/seconds, 1) if seconds > 0 else None,
+                        "peak_rss_kb": peak, "rss_over_baseline_kb": peak-baseline}
+            self.results[name].append(result)
+            self.l.log("Benchmark: "+name+" at scale "+str(scale)+": "+str(items)+" items in "+
+                        "%.3f" % seconds+"s ("+str(result["items_per_s"])+"/s), peak RSS "+
+                        str(peak)+"KB ("+str(peak-baseline)+"KB over an idle worker)")
+
+    """
+    Report
+    """
+
+    def save(self):
+        """Writes benchmark_report.json with the results of every scale and
+        the scaling exponents of time and memory with the number of items
+        (1.0 is linear)"""
+        report = {"created": time.time(), "scales": self.args.scales, "repeat": self.args.repeat,
+                    "seed": self.args.seed, "benchmarks": {}}
+        for name in self.names:
+            results = self.results[name]
+            items = [result["items"] for result in results]
+            report["benchmarks"][name] = {
+                "results": results,
+                "time_exponent": slope(items, [result["seconds"] for result in results]),
+                "memory_exponent": slope(items, [result["rss_over_baseline_kb"] for result in results])}
+        outpath = self.args.outdir+"benchmark_report.json"
+        json.dump(report, open(outpath, 'w'), indent=1, sort_keys=True)
+        self.l.log("Benchmark: Report saved to "+outpath)
+
+if __name__ == "__main__":
+    print("\n=====================")
+    print("=   hpileup bench   =")
+    print("=====================\n")
+
+    p = argparse.ArgumentParser(description="Benchmarks of the hpileup Python hot paths on synthetic data")
+
+    p.add_argument("--outdir", default="./benchmark/",
+                    help="The directory for the synthetic data sets and the report")
+    p.add_argument("--scales", nargs='+', type=float, default=[1, 2, 4, 8],
+                    help="Data set sizes to benchmark, as multiples of the base size (2x200kb reference, 8 duplications, 20000 sample reads)")
+    p.add_argument("--repeat", type=int, default=3,
+                    help="The number of runs of each benchmark per scale (the fastest is reported)")
+    p.add_argument("--seed", type=int, default=1, help="Random seed for the synthetic data")
+    p.add_argument("--only", nargs='+', choices=sorted(BENCHMARKS.keys()),
+                    help="Run only these benchmarks")
+
+    args = p.parse_args()
+    if args.outdir[-1] != "/":
+        args.outdir = args.outdir+"/"
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+    Benchmark(args)
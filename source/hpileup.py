@@ -25,13 +25,21 @@ import tools.formats.Bed as Bed
 from tools.io.Log import Log
 
 #Local
-import Alignment
-import FakeFastq
+from Alignment import ALIGNERS
 import FastaSubset
-import HomologMapping
-from Pileup import Pileup
+from HomologDiscovery import HomologDiscovery
+import Metrics
+from Pileup import pileup_sample
+from SampleScheduler import SampleScheduler
 from SamRegionFilter import SamRegionFilter as SRF
-from VariantCalling import VariantCalling
+from SegGATK import SegGATK
+from SubsetReference import SubsetReference
+from TaskGraph import Task, TaskGraph
+from VariantCalling import VariantCalling, variant_calling_sample
+
+PILEUP_MEMORY = 4  #GB per pileup task, mostly the read aligner's genome index
+SORT_MEMORY = 1  #GB per sorted BAM task (samtools sort)
+GATK_MEMORY = 2  #GB per GATK region task (JVM heap)
 
 class Hpileup:
     """Driver class for the pipeline, executes all analysis"""
@@ -50,28 +58,69 @@ class Hpileup:
         if self.args.outdir[-1] != "/":
             self.args.outdir = self.args.outdir+"/"
 
-        ##Generate FakeFastq file
-        self.l.log("Generating the artificial FASTQ file for "+self.args.input+"...")
-        ffq = FakeFastq.FakeFastq(self.input_bed, self.args.ref)
-        ffq.save(self.args.outdir+"artificial_reads.fq")
+        ##the run report is written next to ploidy.bed, even if a stage fails
+        Metrics.reset(self.args)
+        try:
+            self.run()
+        finally:
+            Metrics.write_report(self.args)
+            self.l.log("Run report saved to "+self.args.outdir+Metrics.REPORT_FILE)
+
+    def run(self):
+        """Runs the pipeline stages"""
+        ##Generate artificial reads, align them and map homologs, per chromosome
+        self.l.log("Mapping homologs of the regions in "+self.args.input+"...")
+        with Metrics.Stage(self.args, "homolog-discovery"):
+            HomologDiscovery(self.args, self.input_bed)
+
+        ##Build the homolog-only reference for sample realignment
+        if self.args.subset_ref:
+            self.l.log("Building the homolog-only realignment reference...")
+            with Metrics.Stage(self.args, "subset-reference"):
+                SubsetReference(self.args, build=True)
 
-        ##Run the Bowtie 2 aligner on the artificial reads
-        Alignment.Alignment(self.args, self.args.outdir+"artificial_reads.fq", 
-                            self.args.outdir+"artificial_aligned.sam")
+        ##Sam pileup and variant calling, as one graph of per-sample and per-region tasks
+        with Metrics.Stage(self.args, "samples"):
+            self.run_samples()
 
-        ##Run the HomologMapping scripts
-        self.l.log("Compiling all homologous reads...")
-        qm = HomologMapping.QnameMaps(self.args.outdir+"artificial_aligned.sam", self.args.input)
-        self.l.log("Merging homologous reads...")
-        mm = HomologMapping.MergedMaps(qm, filt_len=1000)
-        self.l.log("Saving ploidy info to "+self.args.outdir+"ploidy.bed")
-        mm.save(self.args.outdir)
+    def run_samples(self):
+        """Builds the task graph of the pileup and variant calling stages and
+        runs it: each sample's pileup, then its sorted BAM, then one GATK task
+        per region job of its call set (all samples with --joint), then the
+        VCF merge.  Each task starts as soon as its own dependencies are done.
+        Pileup and sorted BAM tasks ask for the per-sample thread share and
+        start with at least half of it; their tools get the slots granted"""
+        if not os.path.exists(self.args.outdir+"logs"):
+            os.makedirs(self.args.outdir+"logs")
+        graph = TaskGraph(self.args.threads, self.args.max_memory)
+        scheduler = SampleScheduler(self.args, "pileup")
+        min_threads = max(1, scheduler.sample_threads//2)
+        vc = VariantCalling(self.args)
 
-        ##Sam pileup
-        Pileup(self.args)
+        bams = {}  #{sample path: sorted BAM Task}
+        for sample_path in self.args.samples:
+            pileup = graph.add(Task("pileup:"+sample_path, pileup_sample, (self.args, sample_path),
+                                    cpus=scheduler.sample_threads, min_cpus=min_threads,
+                                    memory=PILEUP_MEMORY, process=True,
+                                    logpath=scheduler.log_path(sample_path)))
+            bams[sample_path] = graph.add(Task("sorted-bam:"+sample_path, variant_calling_sample,
+                                                (self.args, sample_path), deps=[pileup],
+                                                cpus=scheduler.sample_threads, min_cpus=min_threads,
+                                                memory=SORT_MEMORY, priority=1, process=True,
+                                                logpath=scheduler.log_path(sample_path)))
 
-        ##Variant Calling
-        VariantCalling(self.args)
+        if self.args.joint:
+            call_sets = [self.args.samples]
+        else:
+            call_sets = [[sample_path] for sample_path in self.args.samples]
+        for sample_paths in call_sets:
+            segs = SegGATK([vc.sorted_bam(sample_path) for sample_path in sample_paths], self.args)
+            deps = [bams[sample_path] for sample_path in sample_paths]
+            jobs = [graph.add(Task("gatk:"+job.outpath, segs.call_job, (job,), deps=deps,
+                                    memory=GATK_MEMORY, priority=2)) for job in segs.jobs]
+            graph.add(Task("merge-vcf:"+','.join(sample_paths), vc.finish_call_set, (segs, sample_paths),
+                            deps=deps+jobs, priority=3))
+        graph.run()
 
 if __name__ == "__main__":
     print("\n===============")
@@ -85,20 +134,60 @@ if __name__ == "__main__":
     p.add_argument("-r", "--ref", required=True,
                     help="The path to the reference genome FASTA (not pre-generated Bowtie2 files)")
     p.add_argument("-s", "--samples", nargs='+', required=True,
-                    help="Paths to one or more SAM/BAM files (BAMs will be converted to SAMs)")
+                    help="Paths to one or more SAM/BAM/CRAM files (BAM/CRAMs are read directly)")
     p.add_argument("-g", "--gatk", required=True,
                     help="Path to the GenomeAnalysisTK jar")
-    p.add_argument("-p", "--picard", required=True,
-                    help="Path to the Picard jar")
+    p.add_argument("-p", "--picard",
+                    help="Path to the Picard jar (no longer used, read groups are added by hpileup)")
+    p.add_argument("--sample_names", nargs='+',
+                    help="Read group sample names (SM) for --samples, in the same order (default: the file names)")
+    p.add_argument("--rg_platform", default="illumina",
+                    help="Read group platform (PL) for all samples")
     p.add_argument("--outdir", default="./", help="The directory to use for results")
     p.add_argument("--bowtie2_loc", default="bowtie2",
                     help="If Bowtie2 is not in your PATH, use this option to specify its location")
-    p.add_argument("--bowtie2_ref", required=True,
-                    help="The location of the Bowtie2 reference files")
+    p.add_argument("--bowtie2_ref",
+                    help="The location of the Bowtie2 reference files (needed when an aligner is bowtie)")
+    p.add_argument("--bwa_loc", default="bwa",
+                    help="If BWA is not in your PATH, use this option to specify its location")
+    p.add_argument("--bwa_ref",
+                    help="The prefix of the BWA index files (needed when an aligner is bwamem)")
+    p.add_argument("--tile_aligner", default="bowtie", choices=sorted(ALIGNERS.keys()),
+                    help="The aligner for the artificial reads of homolog discovery")
+    p.add_argument("--read_aligner", default="bowtie", choices=sorted(ALIGNERS.keys()),
+                    help="The aligner for the realignment of sample reads in the pileup stage")
     p.add_argument("--samtools_loc", default="samtools",
                     help="If samtools is not in your PATH, use this option to specify its location")
     p.add_argument("--threads", type=int, default=1,
-                    help="The number of threads to use for multi-threaded components (Bowtie2 and GATK)")
+                    help="The number of threads to use for multi-threaded components (the aligners and GATK)")
+    p.add_argument("--parallel_samples", type=int, default=1,
+                    help="The number of samples to process at once in the pileup and variant calling stages (--threads is split between them)")
+    p.add_argument("--batch_ploidy", action="store_true",
+                    help="Call GATK once per distinct ploidy with all regions of that ploidy, instead of once per ploidy region")
+    p.add_argument("--chunk_size", type=int, default=0,
+                    help="Split ploidy regions longer than this many bases into windows that are called in parallel (0 disables splitting)")
+    p.add_argument("--chunk_padding", type=int, default=500,
+                    help="The number of bases each --chunk_size window is padded by on both sides")
+    p.add_argument("--joint", action="store_true",
+                    help="Call all samples together in one GATK run per ploidy region (or ploidy with --batch_ploidy), writing a multi-sample cohort VCF")
+    p.add_argument("--stream", action="store_true",
+                    help="Pipe the filter, samtools collate/fastq and realignment steps of the pileup stage together instead of writing intermediate files")
+    p.add_argument("--homolog_db",
+                    help="Directory of a persistent homolog store, reused across runs with the same reference (regions missing from it are discovered and added)")
+    p.add_argument("--max_memory", type=float,
+                    help="Memory budget in GB for concurrent pileup, sorting and GATK tasks (default: not limited)")
+    p.add_argument("--force", action="store_true",
+                    help="Rerun every stage, ignoring the checkpoints of earlier runs in --outdir")
+    p.add_argument("--subset_ref", action="store_true",
+                    help="Realign sample reads against an index of only the input and homologous regions, built for --read_aligner, instead of the whole genome index")
     
     args = p.parse_args()
+    if args.sample_names != None and len(args.sample_names) != len(args.samples):
+        p.error("--sample_names must give one name per sample")
+    ##the read aligner's genome index is not used when realigning against the subset reference
+    aligners = [args.tile_aligner] if args.subset_ref else [args.tile_aligner, args.read_aligner]
+    if "bowtie" in aligners and args.bowtie2_ref == None:
+        p.error("--bowtie2_ref is required to align with bowtie")
+    if "bwamem" in aligners and args.bwa_ref == None:
+        p.error("--bwa_ref is required to align with bwamem")
     Hpileup(args)